@@ -0,0 +1,134 @@
+# Epidemic metrics updated incrementally from the counters of each cycle.
+#
+# Every update is a constant number of operations, whatever the length of
+# the run. The growth rate is the slope of an exponentially weighted least
+# squares fit of log(infected) against the cycle, so recent cycles count the
+# most and no history has to be kept. Counters can be single runs or arrays
+# holding one value per replicate, every metric then has the same shape.
+import numpy as np
+
+
+# Metrics returned by Analytics.snapshot(), in order
+METRICS = ("growth_rate", "doubling_time", "attack_rate", "peak", "peak_tick", "extinction")
+
+
+class Analytics:
+    '''
+    Purpose: Tracks the growth, size, peak and end of an epidemic.
+
+    Args:
+        population: number of people in the simulation
+        halflife: cycles after which a count has half the weight in the fit
+        peak_drop: share infected must fall from its highest for the peak
+            to count as passed
+        shape: shape of the counters, () for a single run or (replicates,)
+    '''
+
+    def __init__(self, population: int, halflife=50, peak_drop=0.1, shape=()) -> None:
+
+        self.population = population
+        self.decay = 0.5 ** (1 / halflife)
+        self.peak_drop = peak_drop
+        self.tick = 0
+
+        # Weighted sums of the fit, u is the cycle of a count relative to the
+        # latest one, so the sums stay small however long the run
+        self.weight = np.zeros(shape)
+        self.u = np.zeros(shape)
+        self.uu = np.zeros(shape)
+        self.y = np.zeros(shape)
+        self.uy = np.zeros(shape)
+
+        self.infected = np.zeros(shape)
+        self.infections = np.zeros(shape)
+        self.peak = np.zeros(shape)
+        self.peak_tick = np.zeros(shape)
+        # Cycle the last infected person was cured or died, nan until then
+        self.extinct = np.full(shape, np.nan)
+
+    def update(self, tick: int, infected, infections) -> None:
+        '''
+        Adds the counters of a cycle.
+
+        Arguments:
+            tick: cycle the counters are from
+            infected: number of people infected now
+            infections: number of infections since the start
+        '''
+        infected = np.asarray(infected, dtype=np.float64)
+        self.tick = tick
+        self.infected = infected
+        self.infections = np.asarray(infections, dtype=np.float64)
+
+        # Move every earlier count a cycle further back and fade its weight
+        d = self.decay
+        self.uu = d * (self.uu - 2 * self.u + self.weight)
+        self.u = d * (self.u - self.weight)
+        self.uy = d * (self.uy - self.y)
+        self.y = d * self.y
+        self.weight = d * self.weight
+
+        # log(0) is undefined, cycles with nobody infected are left out of the fit
+        present = infected > 0
+        self.weight = self.weight + present
+        self.y = self.y + np.where(present, np.log(np.maximum(infected, 1)), 0)
+
+        higher = infected > self.peak
+        self.peak = np.where(higher, infected, self.peak)
+        self.peak_tick = np.where(higher, tick, self.peak_tick)
+
+        ended = np.isnan(self.extinct) & ~present & (self.peak > 0)
+        self.extinct = np.where(ended, tick, self.extinct)
+
+    def growth_rate(self) -> np.ndarray:
+        '''
+        Returns the exponential growth rate of the infected per cycle, nan
+        until there are two cycles to fit.
+        '''
+        spread = self.weight * self.uu - self.u * self.u
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = (self.weight * self.uy - self.u * self.y) / spread
+        return np.where(spread > 1e-9, slope, np.nan)
+
+    def doubling_time(self) -> np.ndarray:
+        '''
+        Returns the cycles the infected take to double, inf when not growing.
+        '''
+        rate = self.growth_rate()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(rate > 1e-9, np.log(2) / rate, np.inf)
+
+    def attack_rate(self) -> np.ndarray:
+        '''
+        Returns the share of the population infected so far, counting reinfections.
+        '''
+        return self.infections / self.population
+
+    def peaked(self) -> np.ndarray:
+        '''
+        Returns whether the infected have fallen far enough from their highest
+        for it to count as the peak.
+        '''
+        return (self.peak > 0) & (self.infected <= self.peak * (1 - self.peak_drop))
+
+    def extinction(self) -> np.ndarray:
+        '''
+        Returns the cycle the last infected person recovers or dies. Before
+        that, it is projected from the current decline, nan while growing.
+        '''
+        rate = self.growth_rate()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            projected = np.where(rate < -1e-9, self.tick + np.log(np.maximum(self.infected, 1)) / -rate, np.nan)
+        return np.where(np.isnan(self.extinct), projected, self.extinct)
+
+    def snapshot(self) -> dict:
+        '''
+        Returns every metric, keyed by the names in METRICS.
+        '''
+        return {
+            "growth_rate": self.growth_rate(),
+            "doubling_time": self.doubling_time(),
+            "attack_rate": self.attack_rate(),
+            "peak": self.peak,
+            "peak_tick": self.peak_tick,
+            "extinction": self.extinction()}
@@ -0,0 +1,272 @@
+# Fits pathogen and movement settings to an observed epidemic.
+#
+# The target is a csv file with a header naming any of the counters in
+# ensemble.COLUMNS and one row per cycle from the start, for example the
+# infected and dead people of each day scaled to the simulated population.
+# Settings are searched with approximate Bayesian computation by sequential
+# Monte Carlo: a population of candidate settings is drawn from the ranges in
+# config.json, and every generation keeps the candidates whose runs come
+# closest to the target, perturbs them and runs them again under a tighter
+# tolerance. Candidates of a generation are run by headless engines in
+# parallel across cores, and a run is dropped as soon as its error can no
+# longer come in under the tolerance.
+#
+# Configured with "calibration" in config.json, for example:
+#
+#   "calibration": {"parameters": {"pathogen.infectiousness": [0.01, 0.3],
+#                   "sim.movement": [0, 0.1]}, "particles": 32, "generations": 4}
+#
+# Usage: python calibrate.py target.csv [config.json] [output.csv]
+import multiprocessing, sys
+import numpy as np
+
+import config, ensemble
+
+
+# Settings that can be fitted, as section.setting
+PARAMETERS = ("pathogen.infectiousness", "pathogen.catchment", "pathogen.curability",
+        "pathogen.lethality", "sim.movement", "sim.migration")
+
+# Defaults of the "calibration" settings
+DEFAULTS = {
+    "parameters": {},
+    "particles": 32,        # candidates kept each generation
+    "generations": 4,
+    "quantile": 0.5,        # share of the last generation the next tolerance lets through
+    "replicates": 4,        # replicates averaged per run
+    "seed": 0,              # seed every run uses, so runs differ only by their settings
+    "processes": 0,         # worker processes, 0 for one per core
+    "attempts": 50}         # runs per kept candidate after which a generation gives up
+
+
+def read_target(path: str) -> tuple:
+    '''
+    Reads the counters to fit to.
+
+    Returns:
+        (columns, target), the indices of the counters in ensemble.COLUMNS
+        and a (cycles, len(columns)) array of their values
+    '''
+    data = np.genfromtxt(path, delimiter=",", names=True)
+    names = [name for name in data.dtype.names if name in ensemble.COLUMNS]
+    if len(names) == 0:
+        raise ValueError(f'{path} must have a column named one of {", ".join(ensemble.COLUMNS)}')
+
+    target = np.column_stack([np.atleast_1d(data[name]) for name in names])
+    return [ensemble.COLUMNS.index(name) for name in names], target
+
+
+# Set in every worker process by _start_worker()
+_columns = None
+_target = None
+_settings = None
+
+
+def _start_worker(config_addr: str, columns: list, target: np.ndarray) -> None:
+    '''
+    Loads the configuration and target in a worker process.
+    '''
+    global _columns, _target, _settings
+
+    config.load(config_addr, show_menu=False)
+    _columns, _target = columns, target
+    _settings = dict(DEFAULTS, **config.calibration)
+
+
+def evaluate(candidate: dict, tolerance: float) -> float:
+    '''
+    Runs a candidate in a worker process and returns the root mean square
+    difference between the share of the population in each target counter
+    and the target, averaged over the replicates.
+
+    Arguments:
+        candidate: value of each setting, keyed by its name in PARAMETERS
+        tolerance: distance above which the run is dropped
+
+    Returns:
+        the distance, inf when the run was dropped
+    '''
+    import engine
+
+    for name, value in candidate.items():
+        section, setting = name.split(".")
+        setattr(getattr(config, section), setting, value)
+
+    simulation = engine.Engine(_settings["seed"], _settings["replicates"])
+    target = _target / simulation.scenario.people
+
+    # Squared errors only add up, so once they pass the budget the run cannot
+    # end within the tolerance
+    budget = tolerance ** 2 * target.size
+    error = 0.0
+
+    for tick in range(target.shape[0]):
+        if tick > 0:
+            simulation.step()
+
+        shares = simulation.history[-1][:, _columns].mean(axis=0) / simulation.scenario.people
+        error += ((shares - target[tick]) ** 2).sum()
+        if error > budget:
+            return np.inf
+
+    return np.sqrt(error / target.size)
+
+
+class Calibration:
+    '''
+    Purpose: Approximate Bayesian computation of the settings of a run.
+
+    Args:
+        settings: "calibration" from config.json, see DEFAULTS
+        rng: generator candidates are drawn with
+    '''
+
+    def __init__(self, settings: dict, rng: np.random.Generator) -> None:
+
+        self.settings = dict(DEFAULTS, **settings)
+        self.rng = rng
+
+        self.names = list(self.settings["parameters"])
+        unknown = [name for name in self.names if name not in PARAMETERS]
+        if len(self.names) == 0 or len(unknown) > 0:
+            raise ValueError(f'Calibration parameters must be some of {", ".join(PARAMETERS)}')
+
+        bounds = np.array([self.settings["parameters"][name] for name in self.names], dtype=np.float64)
+        self.low, self.high = bounds[:, 0], bounds[:, 1]
+        # Whole number settings are only tried at whole numbers
+        self.whole = np.array([isinstance(getattr(getattr(config, name.split(".")[0]), name.split(".")[1]), int)
+                for name in self.names])
+
+        # Candidates of the last generation, their weights and distances
+        self.particles = None
+        self.weights = None
+        self.distances = None
+        self.tolerance = np.inf
+
+    def candidates(self, count: int) -> np.ndarray:
+        '''
+        Draws candidates from the ranges, or by perturbing the last
+        generation once there is one.
+
+        Returns:
+            (count, parameters) array
+        '''
+        if self.particles is None:
+            drawn = self.rng.uniform(self.low, self.high, (count, len(self.names)))
+        else:
+            picked = self.rng.choice(self.particles.shape[0], count, p=self.weights)
+            drawn = self.particles[picked] + self.rng.normal(0, self.__kernel(), (count, len(self.names)))
+            # Candidates outside the ranges have no prior support, they are reflected back in
+            drawn = np.abs(drawn - self.low) + self.low
+            drawn = self.high - np.abs(self.high - drawn)
+            drawn = np.clip(drawn, self.low, self.high)
+
+        return np.where(self.whole, np.round(drawn), drawn)
+
+    def generation(self, pool) -> bool:
+        '''
+        Runs candidates on a multiprocessing.Pool until enough are within
+        the tolerance to make the next generation.
+
+        Returns:
+            whether the generation was completed within the allowed attempts
+        '''
+        wanted = self.settings["particles"]
+        kept, distances = [], []
+        attempts = 0
+
+        while len(kept) < wanted and attempts < wanted * self.settings["attempts"]:
+
+            batch = self.candidates(wanted)
+            jobs = [(self.__settings(candidate), self.tolerance) for candidate in batch]
+            results = np.array(pool.starmap(evaluate, jobs))
+            attempts += batch.shape[0]
+
+            # Strictly within, runs that die out at once all tie and would hold the tolerance still
+            within = results < self.tolerance
+            kept.extend(batch[within])
+            distances.extend(results[within])
+
+        if len(kept) < wanted:
+            return False
+
+        particles = np.array(kept[:wanted])
+        self.weights = self.__weigh(particles)
+        self.particles = particles
+        self.distances = np.array(distances[:wanted])
+        self.tolerance = np.quantile(self.distances, self.settings["quantile"])
+        return True
+
+    def __settings(self, candidate: np.ndarray) -> dict:
+        '''
+        Returns the settings of a candidate keyed by their names in PARAMETERS.
+        '''
+        return {name: int(value) if whole else float(value)
+                for name, value, whole in zip(self.names, candidate, self.whole)}
+
+    def __kernel(self) -> np.ndarray:
+        '''
+        Returns the spread of the perturbations of each setting, twice the
+        weighted variance of the last generation.
+        '''
+        mean = np.average(self.particles, axis=0, weights=self.weights)
+        variance = np.average((self.particles - mean) ** 2, axis=0, weights=self.weights)
+        return np.sqrt(2 * variance) + 1e-12
+
+    def __weigh(self, particles: np.ndarray) -> np.ndarray:
+        '''
+        Returns the importance weights of new candidates. The ranges are flat
+        priors, so a candidate weighs the inverse of how likely the
+        perturbations of the last generation were to reach it.
+        '''
+        if self.particles is None:
+            return np.full(particles.shape[0], 1 / particles.shape[0])
+
+        spread = self.__kernel()
+        offsets = (particles[:, None, :] - self.particles[None, :, :]) / spread
+        density = np.exp(-0.5 * (offsets ** 2).sum(axis=2)) @ self.weights
+
+        weights = 1 / density
+        return weights / weights.sum()
+
+    def write_csv(self, path: str) -> None:
+        '''
+        Writes the candidates of the last generation with their weights and distances.
+        '''
+        header = self.names + ["weight", "distance"]
+        rows = np.column_stack([self.particles, self.weights, self.distances])
+        np.savetxt(path, rows, delimiter=",", header=",".join(header), comments="", fmt="%g")
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python calibrate.py target.csv [config.json] [output.csv]")
+
+    target_addr = sys.argv[1]
+    config_addr = sys.argv[2] if len(sys.argv) > 2 else "config.json"
+    output = sys.argv[3] if len(sys.argv) > 3 else "calibration.csv"
+    config.load(config_addr, show_menu=False)
+
+    columns, target = read_target(target_addr)
+    calibration = Calibration(config.calibration, np.random.default_rng(config.calibration.get("seed", 0)))
+    processes = calibration.settings["processes"] or None
+
+    with multiprocessing.Pool(processes, _start_worker, (config_addr, columns, target)) as pool:
+        for number in range(calibration.settings["generations"]):
+
+            if not calibration.generation(pool):
+                print(f'Generation {number} found too few candidates within {calibration.tolerance:g}, stopping')
+                break
+            print(f'Generation {number}: median distance {np.median(calibration.distances):g}, '
+                    f'next tolerance {calibration.tolerance:g}')
+
+    if calibration.particles is None:
+        sys.exit("No candidates were found")
+
+    calibration.write_csv(output)
+    mean = np.average(calibration.particles, axis=0, weights=calibration.weights)
+    best = calibration.particles[np.argmin(calibration.distances)]
+    for name, average, value in zip(calibration.names, mean, best):
+        print(f'{name}: mean {average:g}, best {value:g}')
+    print(f'Candidates written to {output}')
@@ -2,7 +2,7 @@ import json
 import tkinter as tk
 from tkinter import ttk
 import numpy as np
-from dataclasses import dataclass
+from dataclasses import dataclass, fields, MISSING
 
 
 class _RadioFrame(ttk.LabelFrame):
@@ -127,6 +127,14 @@ class _Menu(tk.Tk):
         )
         self.infectiousness.grid(row=3, column=0, pady=5)
 
+        self.immunity = _RadioFrame(
+            self.pathogen_frame,
+            "Immunity",
+            {"Permanent": "0", "Long": "3000", "Short": "1000"},
+            self.config["pathogen"]["immunity"]
+        )
+        self.immunity.grid(row=4, column=0, pady=5)
+
         self.mitigation_frame = ttk.LabelFrame(self.column0, text="Mitigations")
         self.mitigation_frame.pack(padx=5, pady=5)
 
@@ -153,11 +161,11 @@ class _Menu(tk.Tk):
         self.layout_frame = ttk.LabelFrame(self.column1, text="Community Layout")
         self.layout_frame.pack(side=tk.TOP, padx=5, pady=10)
 
-        self.rows = _Slider(self.layout_frame, "Rows", 1, 8,
+        self.rows = _Slider(self.layout_frame, "Rows", 1, 32,
                 len(self.config["simulation"]["layout"]))
         self.rows.grid(row=0, column=0, padx=5, pady=5)
 
-        self.cols = _Slider(self.layout_frame, "Columns", 1, 8,
+        self.cols = _Slider(self.layout_frame, "Columns", 1, 32,
                 len(self.config["simulation"]["layout"][0]))
         self.cols.grid(row=1, column=0, padx=5, pady=5)
 
@@ -192,6 +200,7 @@ class _Menu(tk.Tk):
         self.config["pathogen"]["curability"] = float(self.curability.fetch())
         self.config["pathogen"]["catchment"] = int(self.catchment.fetch())
         self.config["pathogen"]["infectiousness"] = float(self.infectiousness.fetch())
+        self.config["pathogen"]["immunity"] = int(self.immunity.fetch())
 
         self.config["simulation"]["migrations"] = float(self.migrations.fetch())
         self.config["simulation"]["movements"] = float(self.movements.fetch())
@@ -260,6 +269,8 @@ class _Sim:
     immune: int
     susceptible: int
     infected: int
+    topology: object = "all"
+    quiet_stride: int = 10
 
 
 @dataclass
@@ -268,6 +279,9 @@ class _App:
     sidebar_width: int
     bar_height: int
     theme: str
+    min_community: int = 30
+    render: str = "agents"
+    heatmap_cell: int = 5
 
 
 @dataclass
@@ -276,19 +290,122 @@ class _Pathogen:
     curability: float
     infectiousness: float
     lethality: float
+    immunity: int = 0
+    place_infectiousness: float = 0.0
+
+
+# Keys of config.json that differ from the field they fill
+_RENAMED = {"movements": "movement", "migrations": "migration"}
+
+# Values accepted for fields of each type, ints are accepted for floats
+_TYPES = {int: (int,), float: (int, float), str: (str,), list: (list,), tuple[int, int]: (list,), tuple[int, int, int]: (list,)}
+
+
+def _section(cls, name: str, values: dict):
+    '''
+    Builds a settings dataclass from a section of the config by key name.
+
+    Args:
+        cls: dataclass to build
+        name: name of the section, used in error messages
+        values: dict read from config.json
+
+    Raises:
+        ValueError: on unknown or missing keys and values of the wrong type
+    '''
+    known = {field.name: field for field in fields(cls)}
+    settings = {}
+
+    for key, value in values.items():
+        field = _RENAMED.get(key, key)
+        if field not in known:
+            raise ValueError(f'Unknown setting "{key}" in {name}')
+
+        accepted = _TYPES.get(known[field].type)
+        if accepted is not None and (isinstance(value, bool) or not isinstance(value, accepted)):
+            raise ValueError(f'Setting "{key}" in {name} must be {known[field].type.__name__}, got {value!r}')
+
+        settings[field] = value
+
+    missing = [field for field in known if field not in settings and known[field].default is MISSING]
+    if len(missing) > 0:
+        raise ValueError(f'Missing settings in {name}: {", ".join(missing)}')
+
+    return cls(**settings)
+
+
+# Settings read by load(), the menu is opened when one is first needed
+SETTINGS = ("sim", "app", "theme", "pathogen", "interventions", "tracing", "ensemble", "control", "scenario", "stop", "calibration", "record")
+
+
+def load(config_addr="config.json", show_menu=True) -> None:
+    '''
+    Reads the configuration into the module level settings.
+
+    Args:
+        config_addr: path of the config file
+        show_menu: let the user edit the configuration in the menu first,
+            headless tools read the file as it is
+    '''
+    if show_menu:
+        menu = _Menu(config_addr)
+        menu.mainloop()
+        config = menu.config
+    else:
+        with open(config_addr, "r") as config_file:
+            config = json.loads(config_file.read())
+
+    apply(config)
+
+
+def apply(config: dict) -> None:
+    '''
+    Validates a configuration and sets the module level settings from it.
+
+    Args:
+        config: dict in the form of config.json
+    '''
+    global sim, app, theme, pathogen, interventions, tracing, ensemble, control, scenario, stop, calibration, record
+
+    sim = _section(_Sim, "simulation", config["simulation"])
+    app = _section(_App, "app", config["app"])
+    theme = _section(_Theme, f'theme {app.theme}', config["theme"][app.theme])
+    pathogen = _section(_Pathogen, "pathogen", config["pathogen"])
+
+    if app.render not in ("agents", "heatmap"):
+        raise ValueError(f'App render must be "agents" or "heatmap", got {app.render!r}')
+    if sum(pop for cols in sim.layout for pop, _ in cols) != sim.population:
+        raise ValueError("Simulation population must be the total population of the layout")
+    interventions = config.get("interventions", [])
+    tracing = config.get("tracing", {})
+    ensemble = config.get("ensemble", {})
+    control = config.get("control", {})
+    scenario = config.get("scenario", {})
+    stop = config.get("stop", {})
+    calibration = config.get("calibration", {})
+    record = config.get("record", {})
 
 
-menu = _Menu()
-menu.mainloop()
+def __getattr__(name):
+    # Settings are loaded through the menu on first use unless load() was called already
+    if name in SETTINGS:
+        load()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-sim = _Sim(*menu.config["simulation"].values())
-app = _App(*menu.config["app"].values())
-theme = _Theme(*menu.config["theme"][menu.config["app"]["theme"]].values())
-pathogen = _Pathogen(*menu.config["pathogen"].values())
 
 if __name__ == "__main__":
 
+    load()
     print(sim.__dict__)
     print(app.__dict__)
     print(theme.__dict__)
     print(pathogen.__dict__)
+    print(interventions)
+    print(tracing)
+    print(ensemble)
+    print(control)
+    print(scenario)
+    print(stop)
+    print(calibration)
+    print(record)
@@ -0,0 +1,235 @@
+# Remote control of a running simulation over HTTP on localhost.
+#
+# Enabled with "control" in config.json, for example:
+#
+#   "control": {"enabled": true, "host": "127.0.0.1", "port": 8765}
+#
+# or "socket": "/tmp/pandemic.sock" to listen on a Unix socket instead.
+#
+#   GET  /stats          latest Stats of the simulation as JSON
+#   GET  /stream         one JSON line of Stats per cycle until disconnected
+#   POST /pause          pauses the simulation
+#   POST /resume         resumes the simulation
+#   POST /speed          {"speed": "slow" | "normal" | "fast"}
+#   POST /pathogen       {"infectiousness": 0.05, ...} any pathogen setting
+#   POST /interventions  an interventions entry, see interventions.py
+#   POST /stop           ends the simulation
+#
+# The server runs an asyncio loop on its own thread. Commands are handed to
+# the simulation as pygame events, so they are applied between cycles by the
+# same event handler as key presses, and wake a paused simulation which
+# blocks on the event queue.
+import asyncio, json, threading
+import pygame
+
+import interventions
+
+
+# Event type commands are posted to the pygame event queue with
+EVENT = pygame.event.custom_type()
+
+# Names accepted by /speed, and the delay between cycles of each
+SPEEDS = {"slow": 0.064, "normal": 0.016, "fast": 0.008}
+
+# Pathogen settings /pathogen accepts, counts are whole numbers of at least 0
+# and chances are numbers from 0 to 1
+COUNTS = ("catchment", "immunity")
+CHANCES = ("curability", "infectiousness", "lethality", "place_infectiousness")
+
+REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found"}
+
+
+class Server:
+    '''
+    Purpose: Serves the control API of a simulation from a background thread.
+
+    Args:
+        settings: dict read from config.json, see the top of this module
+    '''
+
+    def __init__(self, settings: dict) -> None:
+
+        self.host = settings.get("host", "127.0.0.1")
+        self.port = settings.get("port", 8765)
+        self.socket = settings.get("socket")
+
+        self.loop = None
+        # Error the server thread failed to start listening with
+        self.error = None
+        # Latest snapshot of the stats and a queue for each client streaming them
+        self.latest = {}
+        self.streams = set()
+
+    def start(self) -> None:
+        '''
+        Starts listening on a daemon thread, so the server ends with the simulation.
+        Raises the error the server failed to listen with, such as a port in use.
+        '''
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        thread = threading.Thread(target=self.__serve, args=(ready,), daemon=True)
+        thread.start()
+        ready.wait()
+
+        if self.error is not None:
+            raise self.error
+
+    def publish(self, snapshot: dict) -> None:
+        '''
+        Hands the stats of the latest cycle to the server. Called from the
+        simulation thread once per cycle.
+        '''
+        self.latest = snapshot
+        if len(self.streams) > 0:
+            self.loop.call_soon_threadsafe(self.__broadcast, snapshot)
+
+    def __serve(self, ready: threading.Event) -> None:
+        '''
+        Runs the event loop of the server thread. An error while starting to
+        listen is kept for start() to raise, so it never waits forever.
+        '''
+        asyncio.set_event_loop(self.loop)
+
+        try:
+            if self.socket is not None:
+                server = asyncio.start_unix_server(self.__handle, path=self.socket)
+            else:
+                server = asyncio.start_server(self.__handle, self.host, self.port)
+            self.loop.run_until_complete(server)
+        except Exception as error:
+            self.error = error
+            self.loop.close()
+            return
+        finally:
+            ready.set()
+
+        self.loop.run_forever()
+
+    def __broadcast(self, snapshot: dict) -> None:
+        '''
+        Queues a snapshot for every streaming client, dropping it for
+        clients too slow to keep up rather than holding the simulation.
+        '''
+        for queue in self.streams:
+            if not queue.full():
+                queue.put_nowait(snapshot)
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''
+        Answers a single HTTP request.
+        '''
+        try:
+            method, path, body = await self.__read_request(reader)
+        except (ValueError, asyncio.IncompleteReadError):
+            await self.__respond(writer, 400, {"error": "Malformed request"})
+            return
+
+        if method == "GET" and path == "/stats":
+            await self.__respond(writer, 200, self.latest)
+        elif method == "GET" and path == "/stream":
+            await self.__stream(writer)
+        elif method == "POST":
+            status, reply = self.__command(path, body)
+            await self.__respond(writer, status, reply)
+        else:
+            await self.__respond(writer, 404, {"error": f'No route for {method} {path}'})
+
+    @staticmethod
+    async def __read_request(reader: asyncio.StreamReader) -> tuple:
+        '''
+        Reads the request line, headers and JSON body of a request.
+
+        Returns:
+            (method, path, body) where body is None when empty
+        '''
+        method, path, _ = (await reader.readline()).decode("latin-1").split()
+
+        length = 0
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if line == "":
+                break
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+
+        body = None
+        if length > 0:
+            body = json.loads(await reader.readexactly(length))
+
+        return method, path, body
+
+    @staticmethod
+    async def __respond(writer: asyncio.StreamWriter, status: int, reply: dict) -> None:
+        '''
+        Writes a JSON response and closes the connection.
+        '''
+        content = json.dumps(reply).encode()
+        writer.write(f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                f'Content-Type: application/json\r\nContent-Length: {len(content)}\r\n'
+                'Connection: close\r\n\r\n'.encode() + content)
+        await writer.drain()
+        writer.close()
+
+    async def __stream(self, writer: asyncio.StreamWriter) -> None:
+        '''
+        Writes a line of stats for every cycle until the client disconnects.
+        '''
+        queue = asyncio.Queue(maxsize=256)
+        self.streams.add(queue)
+
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nConnection: close\r\n\r\n')
+        try:
+            while True:
+                writer.write(json.dumps(await queue.get()).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.streams.discard(queue)
+            writer.close()
+
+    @staticmethod
+    def __command(path: str, body) -> tuple:
+        '''
+        Checks a command and posts it to the simulation.
+
+        Returns:
+            (status, reply)
+        '''
+        command = path.strip("/")
+        body = body or {}
+        if not isinstance(body, dict):
+            return 400, {"error": "Body must be a JSON object"}
+
+        if command == "speed":
+            if body.get("speed") not in SPEEDS:
+                return 400, {"error": f'Speed must be one of {", ".join(SPEEDS)}'}
+            body = {"delay": SPEEDS[body["speed"]]}
+
+        elif command == "pathogen":
+            unknown = [name for name in body if name not in COUNTS + CHANCES]
+            if len(unknown) > 0:
+                return 400, {"error": f'Unknown pathogen settings: {", ".join(unknown)}'}
+
+            for name, value in body.items():
+                # bool is a subclass of int but never a valid setting
+                number = isinstance(value, (int, float)) and not isinstance(value, bool)
+                if name in COUNTS and not (number and isinstance(value, int) and value >= 0):
+                    return 400, {"error": f'Pathogen {name} must be a whole number of at least 0, got {value!r}'}
+                if name in CHANCES and not (number and 0 <= value <= 1):
+                    return 400, {"error": f'Pathogen {name} must be a number from 0 to 1, got {value!r}'}
+
+        elif command == "interventions":
+            try:
+                interventions.Intervention(body)
+            except (KeyError, ValueError) as error:
+                return 400, {"error": f'Invalid intervention: {error}'}
+
+        elif command not in ("pause", "resume", "stop"):
+            return 404, {"error": f'Unknown command: {command}'}
+
+        # Posting to the pygame queue is thread safe and wakes a paused simulation
+        pygame.event.post(pygame.event.Event(EVENT, command=command, body=body))
+        return 202, {"command": command}
@@ -0,0 +1,588 @@
+# Headless array version of the simulation.
+#
+# Every person of every community is a row in a set of flat arrays, and a
+# cycle is stepped with the kernels module following the same rules as
+# Community.update: people move, the infected spread the pathogen to those
+# within catchment and to the other occupants of places, get cured or die,
+# and some people head to places or migrate. Used for batch runs where no
+# window is needed. The interventions of config.interventions are started
+# and lifted in each replicate on its own, as their triggers on the number
+# of infected are reached at different cycles.
+import copy, time
+import numpy as np
+
+import config, kernels, migration, scenario, analytics, interventions
+from kernels import SUSCEPTIBLE, INFECTED, IMMUNE, DEAD
+
+
+# Arrays holding a row per person, compacted when replicates are retired
+PERSON_ARRAYS = ("replicate", "group", "x", "y", "state", "quarantined", "routing", "dest_x", "dest_y",
+        "vx", "vy", "home_x", "home_y", "has_home", "stay", "target", "place")
+
+
+class Engine:
+    '''
+    Purpose: Steps every community of config.sim.layout at once on flat arrays.
+
+    Replicates are independent copies of the layout stepped together in the
+    same pass. Replicate r holds communities r*C to r*C + C - 1 of the arrays,
+    for C communities in the layout, so the kernels treat them as more
+    communities that migrants never travel between.
+
+    Args:
+        seed: seed of the random generator, the same seed and kernel backend
+            always give the same trajectory
+        replicates: number of copies of the layout to simulate
+        compiled: scenario.Scenario to start from, defaults to the loaded configuration
+    '''
+
+    def __init__(self, seed=None, replicates=1, compiled=None) -> None:
+
+        self.rng = np.random.default_rng(seed)
+        self.scenario = compiled or scenario.current()
+
+        sizes = self.scenario.sizes
+        populations = self.scenario.populations
+        places = self.scenario.places
+        self.replicates = replicates
+        self.communities = self.scenario.communities
+        groups = replicates * self.communities
+
+        # Furthest position a person can take in each community, positions are
+        # fixed point, see kernels.FIXED
+        self.limit_x = kernels.to_fixed(np.tile(sizes[:, 0] - kernels.SIZE, replicates))
+        self.limit_y = kernels.to_fixed(np.tile(sizes[:, 1] - kernels.SIZE, replicates))
+        self.width = int(kernels.to_fixed(sizes[:, 0].max()))
+
+        # Random initial positions, possibly memory-mapped from the scenario cache
+        initial = self.scenario.initial(self.rng, seed, replicates)
+
+        # Per person arrays
+        people = self.scenario.people
+        count = replicates * people
+        self.replicate = np.repeat(np.arange(replicates), people)
+        self.group = (np.tile(np.repeat(np.arange(self.communities), populations), replicates)
+                + self.replicate * self.communities).astype(np.int32)
+        # Converting copies the positions out of the cache, so people can move
+        self.x = kernels.to_fixed(initial["x"])
+        self.y = kernels.to_fixed(initial["y"])
+        self.state = np.full(count, SUSCEPTIBLE, dtype=np.int8)
+        self.quarantined = np.zeros(count, dtype=bool)
+        # Route behaviour, see Person.route
+        self.routing = np.zeros(count, dtype=bool)
+        self.dest_x = np.zeros(count, dtype=np.int32)
+        self.dest_y = np.zeros(count, dtype=np.int32)
+        self.vx = np.zeros(count, dtype=np.int32)
+        self.vy = np.zeros(count, dtype=np.int32)
+        self.home_x = np.zeros(count, dtype=np.int32)
+        self.home_y = np.zeros(count, dtype=np.int32)
+        self.has_home = np.zeros(count, dtype=bool)
+        self.stay = np.full(count, kernels.STAY_TIME, dtype=np.int16)
+        # Place each person is heading to and the place they are inside, -1 for none
+        self.target = np.full(count, -1, dtype=np.int32)
+        self.place = np.full(count, -1, dtype=np.int32)
+
+        # Per place arrays, the places of a community are contiguous
+        self.place_count = np.tile(places, replicates)
+        self.place_group = np.repeat(np.arange(groups), self.place_count)
+        self.place_start = np.concatenate(([0], np.cumsum(self.place_count)[:-1]))
+        self.place_x = kernels.to_fixed(initial["place_x"])
+        self.place_y = kernels.to_fixed(initial["place_y"])
+        self.place_open = np.ones(len(self.place_group), dtype=bool)
+
+        self.network = migration.Network(self.scenario.layout, config.sim.topology)
+        # Network of each replicate, shared until a replicate cuts migration
+        self.networks = [self.network] * replicates
+
+        # Interventions with the cycle each replicate started them, -1 before
+        # then, and whether each replicate lifted them
+        self.timeline = []
+        for entry in config.interventions:
+            self.schedule(entry)
+        # Interventions keeping the places of each community closed, and the
+        # chances of detection of the quarantines in force, see Community.quarantine
+        self.closures = np.zeros(groups, dtype=np.int32)
+        self.detections = [[] for _ in range(groups)]
+        self.detection = np.zeros(groups, dtype=np.float64)
+
+        # People losing immunity, bucketed by the cycle they become susceptible again
+        self.waning = {}
+        self.tick = 0
+
+        # Replicates still simulated person by person, the counts of retired
+        # ones are kept apart along with how many of them lose immunity each cycle
+        self.live = np.ones(replicates, dtype=bool)
+        self.retired = np.zeros((replicates, 4), dtype=np.int64)
+        self.retired_waning = {}
+        # Cycles the counts of each replicate have not changed for
+        self.unchanged = np.zeros(replicates, dtype=np.int64)
+
+        # Infections of each replicate since the start, counting reinfections
+        if self.scenario.cases is None:
+            # Infect first person of every replicate
+            self.state[np.arange(replicates) * people] = INFECTED
+            self.infections = np.ones(replicates, dtype=np.int64)
+        else:
+            self.__warm_start(self.scenario.cases)
+        self.history = [self.counts()]
+
+        self.analytics = analytics.Analytics(people, shape=(replicates,))
+        self.analytics.update(self.tick, self.history[-1][:, INFECTED], self.infections)
+
+    def __warm_start(self, cases: np.ndarray) -> None:
+        '''
+        Starts every replicate from the case counts of each community, given
+        to random people of the community all in one batch.
+
+        Arguments:
+            cases: (communities, 3) array from scenario.read_cases()
+        '''
+        # Groups are contiguous, so shuffling within them ranks everyone in a random order
+        order = np.lexsort((self.rng.random(self.group.shape[0]), self.group))
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.shape[0]) - np.searchsorted(self.group, self.group)
+
+        community = self.group % self.communities
+        infected = cases[community, 1]
+        immune = cases[community, 2]
+
+        self.state[rank < infected + immune] = IMMUNE
+        self.state[rank < infected] = INFECTED
+
+        # Immune people are treated as just cured and lose immunity on schedule
+        if config.pathogen.immunity != 0:
+            self.waning[config.pathogen.immunity] = np.flatnonzero(self.state == IMMUNE)
+
+        # Everyone infected or immune at the start counts as infected once
+        self.infections = np.full(self.replicates, cases[:, 1:].sum(), dtype=np.int64)
+
+    def schedule(self, entry: dict) -> None:
+        '''
+        Schedules another intervention, see interventions.Timeline.add.
+
+        Arguments:
+            entry: dict in the same form as the entries of config.json
+        '''
+        self.timeline.append((interventions.Intervention(entry),
+                np.full(self.replicates, -1, dtype=np.int64), np.zeros(self.replicates, dtype=bool)))
+
+    def counts(self) -> np.ndarray:
+        '''
+        Returns the number of susceptible, infected, immune and dead people.
+
+        Returns:
+            (replicates, 4) array
+        '''
+        live = np.bincount(self.replicate * 4 + self.state, minlength=self.replicates * 4).reshape(-1, 4)
+        return live + self.retired
+
+    def step(self) -> None:
+        '''
+        Simulates one cycle.
+        '''
+        self.tick += 1
+
+        # Release people whose immunity has worn off
+        waning = self.waning.pop(self.tick, None)
+        if waning is not None:
+            waning = waning[self.state[waning] == IMMUNE]
+            self.state[waning] = SUSCEPTIBLE
+        self.__step_retired()
+
+        self.__intervene()
+
+        steps = self.rng.integers(0, 2, (2, self.state.shape[0]), dtype=np.int8)
+        kernels.move(self.x, self.y, self.state, self.quarantined, self.routing,
+                self.dest_x, self.dest_y, self.vx, self.vy, self.home_x, self.home_y,
+                self.has_home, self.stay, self.target, self.place, self.place_open,
+                self.limit_x, self.limit_y, self.group, steps)
+
+        # Only people infected at the start of the cycle can be cured or die in it
+        infected = np.flatnonzero(self.state == INFECTED)
+
+        self.__infect()
+        self.__update_health(infected)
+        self.__movement_events()
+        self.__migration_events()
+
+        self.__record()
+
+    def run(self, ticks: int, stop=None) -> np.ndarray:
+        '''
+        Simulates a number of cycles.
+
+        Replicates are retired once they meet a stop condition, and the rest
+        of their trajectory is filled in without simulating them, see
+        __retire(). Once every replicate is retired or a budget runs out,
+        the remaining cycles are filled in the same way.
+
+        Arguments:
+            ticks: number of cycles
+            stop: dict of stop conditions, defaults to config.stop
+                "extinct": retire replicates once nobody is infected
+                "unchanged": retire replicates whose counts have not changed
+                    for this many cycles, 0 to never
+                "ticks": cycles to simulate at most, 0 for no limit
+                "seconds": wall-clock seconds to simulate for at most, 0 for no limit
+
+        Returns:
+            (cycles + 1, replicates, 4) array of counts, see counts()
+        '''
+        stop = config.stop if stop is None else stop
+        started = time.perf_counter()
+        end = self.tick + ticks
+        budget = self.tick + stop.get("ticks", 0) if stop.get("ticks", 0) > 0 else end
+
+        while self.tick < end:
+
+            seconds = stop.get("seconds", 0)
+            if not self.live.any() or self.tick >= budget or (seconds > 0 and time.perf_counter() - started > seconds):
+                break
+
+            self.step()
+
+            terminal = np.zeros(self.replicates, dtype=bool)
+            if stop.get("extinct", True):
+                terminal |= self.history[-1][:, INFECTED] == 0
+            if stop.get("unchanged", 0) > 0:
+                terminal |= self.unchanged >= stop["unchanged"]
+
+            if (terminal & self.live).any():
+                self.__retire(terminal & self.live)
+
+        # Whatever is still live is projected from where it stopped
+        if self.tick < end and self.live.any():
+            self.__retire(self.live)
+        while self.tick < end:
+            self.tick += 1
+            self.__step_retired()
+            self.__record()
+
+        return np.array(self.history)
+
+    def __record(self) -> None:
+        '''
+        Appends the counts of the cycle to the history and the metrics.
+        '''
+        counts = self.counts()
+        same = (counts == self.history[-1]).all(axis=1)
+        self.unchanged = np.where(same, self.unchanged + 1, 0)
+
+        self.history.append(counts)
+        self.analytics.update(self.tick, counts[:, INFECTED], self.infections)
+
+    def __retire(self, replicates: np.ndarray) -> None:
+        '''
+        Stops simulating replicates person by person. Their counts are
+        stepped by __step_retired() from then on, which is exact for
+        replicates with nobody infected, where only scheduled waning can
+        change anything, and projects the infected of the rest.
+
+        Arguments:
+            replicates: mask of the replicates to retire
+        '''
+        rows = replicates[self.replicate]
+        self.retired[replicates] = self.counts()[replicates]
+        self.live &= ~replicates
+
+        # Move the scheduled waning of retired people into per replicate counts
+        remap = np.cumsum(~rows) - 1
+        for tick in list(self.waning):
+            people = self.waning[tick]
+            leaving = people[rows[people]]
+            leaving = leaving[self.state[leaving] == IMMUNE]
+
+            if leaving.shape[0] > 0:
+                counts = np.bincount(self.replicate[leaving], minlength=self.replicates)
+                self.retired_waning[tick] = self.retired_waning.get(tick, 0) + counts
+
+            self.waning[tick] = remap[people[~rows[people]]]
+
+        # Drop the people of retired replicates, places keep their indices
+        for name in PERSON_ARRAYS:
+            setattr(self, name, getattr(self, name)[~rows])
+
+    def __step_retired(self) -> None:
+        '''
+        Steps the counts of retired replicates by a cycle. Immune people due
+        this cycle become susceptible, and infected people are cured or die
+        with the chances of Pathogen.update_health, drawn as counts. Nobody
+        is infected any more, so the infected of replicates retired before
+        dying out only go down.
+        '''
+        waning = self.retired_waning.pop(self.tick, None)
+        if waning is not None:
+            self.retired[:, IMMUNE] -= waning
+            self.retired[:, SUSCEPTIBLE] += waning
+
+        infected = self.retired[:, INFECTED]
+        if not infected.any():
+            return
+
+        cured = self.rng.binomial(infected, config.pathogen.curability)
+        dead = self.rng.binomial(infected - cured, config.pathogen.lethality)
+        self.retired[:, INFECTED] -= cured + dead
+        self.retired[:, IMMUNE] += cured
+        self.retired[:, DEAD] += dead
+
+        if config.pathogen.immunity != 0 and cured.any():
+            tick = self.tick + config.pathogen.immunity
+            self.retired_waning[tick] = self.retired_waning.get(tick, 0) + cured
+
+    def __infect(self) -> None:
+        '''
+        Spreads the pathogen by proximity outside places and between the
+        occupants of each place, see Pathogen.infect and Pathogen.infect_place.
+        '''
+        outside = (self.place < 0) & ~self.quarantined
+        susceptible = np.flatnonzero(outside & (self.state == SUSCEPTIBLE))
+        infected = np.flatnonzero(outside & (self.state == INFECTED))
+
+        # Each contact infects independently, so k contacts are escaped with (1 - p)^k
+        contacts = kernels.contacts(self.x, self.y, self.group, susceptible, infected,
+                config.pathogen.catchment, self.width)
+        escape = (1 - config.pathogen.infectiousness) ** contacts
+        infections = susceptible[self.rng.random(susceptible.shape[0]) >= escape]
+
+        inside = self.place >= 0
+        occupants = np.flatnonzero(inside & (self.state == SUSCEPTIBLE))
+        sources = np.bincount(self.place[inside & (self.state == INFECTED)], minlength=self.place_open.shape[0])
+        escape = (1 - config.pathogen.place_infectiousness) ** sources[self.place[occupants]]
+        place_infections = occupants[self.rng.random(occupants.shape[0]) >= escape]
+
+        self.state[infections] = INFECTED
+        self.state[place_infections] = INFECTED
+
+        self.infections += np.bincount(self.replicate[infections], minlength=self.replicates)
+        self.infections += np.bincount(self.replicate[place_infections], minlength=self.replicates)
+
+    def __update_health(self, infected: np.ndarray) -> None:
+        '''
+        Cures or kills infected people, see Pathogen.update_health.
+        '''
+        draws = self.rng.random(infected.shape[0])
+        cured = infected[draws < config.pathogen.curability]
+        ill = infected[draws >= config.pathogen.curability]
+        dead = ill[self.rng.random(ill.shape[0]) < config.pathogen.lethality]
+
+        self.state[cured] = IMMUNE
+        self.quarantined[cured] = False
+        self.__schedule_waning(cured)
+
+        # Dead people no longer occupy places
+        self.state[dead] = DEAD
+        self.place[dead] = -1
+        self.target[dead] = -1
+
+        # Detected cases are quarantined where they stand from the next cycle, see Person.isolate
+        if self.detection.any():
+            ill = infected[self.state[infected] == INFECTED]
+            detected = ill[self.rng.random(ill.shape[0]) < self.detection[self.group[ill]]]
+            self.quarantined[detected] = True
+            self.routing[detected] = False
+            self.place[detected] = -1
+            self.target[detected] = -1
+
+    def __intervene(self) -> None:
+        '''
+        Starts and lifts interventions in each live replicate, then applies
+        vaccinations for this cycle, see interventions.Timeline.update.
+        '''
+        infected = self.history[-1][:, INFECTED]
+
+        for intervention, started, lifted in self.timeline:
+            triggered = np.zeros(self.replicates, dtype=bool)
+            if intervention.tick is not None:
+                triggered |= self.tick >= intervention.tick
+            if intervention.infected is not None:
+                triggered |= infected > intervention.infected
+
+            starting = triggered & (started < 0) & self.live
+            started[starting] = self.tick
+            self.__apply(intervention, starting, True)
+
+        for intervention, started, lifted in self.timeline:
+            if intervention.duration is None:
+                continue
+
+            ending = (started >= 0) & ~lifted & self.live & (self.tick >= started + intervention.duration)
+            lifted |= ending
+            self.__apply(intervention, ending, False)
+
+        for intervention, started, lifted in self.timeline:
+            active = (started >= 0) & ~lifted & self.live
+            if intervention.action == "vaccinate" and active.any():
+                self.__vaccinate(self.__groups(intervention, active), intervention.rate)
+
+    def __groups(self, intervention: interventions.Intervention, replicates: np.ndarray) -> np.ndarray:
+        '''
+        Returns the communities an intervention targets in the masked replicates.
+        '''
+        targets = np.arange(self.communities) if intervention.communities is None else np.array(intervention.communities)
+        return (np.flatnonzero(replicates)[:, None] * self.communities + targets).ravel()
+
+    def __apply(self, intervention: interventions.Intervention, replicates: np.ndarray, start: bool) -> None:
+        '''
+        Switches an intervention on or off in the masked replicates, see
+        interventions.Timeline.
+        '''
+        if not replicates.any():
+            return
+        groups = self.__groups(intervention, replicates)
+
+        if intervention.action == "cut_migration":
+            indices = [int(group) for group in np.unique(groups % self.communities)]
+            for replicate in np.flatnonzero(replicates):
+                if self.networks[replicate] is self.network:
+                    self.networks[replicate] = copy.deepcopy(self.network)
+                if start:
+                    self.networks[replicate].block(indices)
+                else:
+                    self.networks[replicate].unblock(indices)
+
+        elif intervention.action == "close_places":
+            closing = np.isin(self.place_group, groups)
+            if start:
+                self.closures[groups] += 1
+                self.place_open[closing] = False
+
+                # Occupants are sent home, see Community.close_places
+                inside = np.flatnonzero(self.place >= 0)
+                occupants = inside[closing[self.place[inside]]]
+                kernels.return_home(occupants, self.x, self.y, self.routing, self.dest_x, self.dest_y,
+                        self.vx, self.vy, self.home_x, self.home_y, self.has_home, self.stay, self.target, self.place)
+            else:
+                # Places reopen once no intervention keeps them closed
+                self.closures[groups] = np.maximum(self.closures[groups] - 1, 0)
+                self.place_open[closing & (self.closures[self.place_group] == 0)] = True
+
+        elif intervention.action == "quarantine":
+            for group in groups:
+                detections = self.detections[group]
+                if start:
+                    detections.append(intervention.detection)
+                elif intervention.detection in detections:
+                    detections.remove(intervention.detection)
+                self.detection[group] = detections[-1] if len(detections) > 0 else 0
+
+    def __vaccinate(self, groups: np.ndarray, rate: int) -> None:
+        '''
+        Vaccinates up to rate susceptible people outside places in the given
+        communities of each replicate, see Timeline.__vaccinate.
+        '''
+        pool = np.flatnonzero((self.state == SUSCEPTIBLE) & (self.place < 0) & np.isin(self.group, groups))
+        if pool.shape[0] == 0:
+            return
+
+        # People are ordered by replicate, so the pool of each is a contiguous run
+        replicates = self.replicate[pool]
+        bounds = np.flatnonzero(np.diff(replicates)) + 1
+        vaccinated = [self.rng.choice(run, min(rate, run.shape[0]), replace=False) for run in np.split(pool, bounds)]
+        vaccinated = np.concatenate(vaccinated)
+
+        self.state[vaccinated] = IMMUNE
+        self.__schedule_waning(vaccinated)
+
+    def __schedule_waning(self, people: np.ndarray) -> None:
+        '''
+        Books the cycle at which newly immune people become susceptible again,
+        see Pathogen.schedule_waning. The immunity can change during a run,
+        so the bucket may already hold people made immune earlier.
+        '''
+        if config.pathogen.immunity == 0 or people.shape[0] == 0:
+            return
+
+        tick = self.tick + config.pathogen.immunity
+        if tick in self.waning:
+            people = np.concatenate([self.waning[tick], people])
+        self.waning[tick] = people
+
+    def __pick(self, chance: float, valid: np.ndarray, allowed: np.ndarray) -> np.ndarray:
+        '''
+        Picks people the way Community events do: each community keeps picking
+        a distinct valid person while a random draw is below chance.
+
+        Arguments:
+            chance: config.sim.movement or config.sim.migration
+            valid: mask of people who may be picked
+            allowed: mask of communities of every replicate events can happen in
+        '''
+        groups = self.limit_x.shape[0]
+        if chance >= 1:
+            wanted = np.full(groups, self.state.shape[0])
+        else:
+            wanted = self.rng.geometric(1 - chance, groups) - 1
+        wanted[~allowed] = 0
+
+        if wanted.sum() == 0:
+            return np.empty(0, dtype=np.int64)
+
+        # Valid people sorted by community so each community is a contiguous run
+        candidates = np.flatnonzero(valid)
+        candidates = candidates[np.argsort(self.group[candidates], kind="stable")]
+        bounds = np.searchsorted(self.group[candidates], np.arange(groups + 1))
+
+        picked = []
+        for community in np.flatnonzero(wanted):
+            members = candidates[bounds[community]:bounds[community + 1]]
+            if members.shape[0] > 0:
+                picked.append(self.rng.choice(members, min(wanted[community], members.shape[0]), replace=False))
+
+        if len(picked) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(picked)
+
+    def __idle(self) -> np.ndarray:
+        '''
+        Returns the mask of people free to visit a place or migrate.
+        '''
+        return (self.state != DEAD) & ~self.routing & ~self.quarantined
+
+    def __movement_events(self) -> None:
+        '''
+        Sends people to a random place in their community, see Person.visit.
+        '''
+        movers = self.__pick(config.sim.movement, self.__idle(), self.place_count > 0)
+        if movers.shape[0] == 0:
+            return
+
+        group = self.group[movers]
+        chosen = self.place_start[group] + self.rng.integers(0, self.place_count[group])
+
+        self.home_x[movers] = self.x[movers]
+        self.home_y[movers] = self.y[movers]
+        self.has_home[movers] = True
+        self.dest_x[movers] = self.place_x[chosen]
+        self.dest_y[movers] = self.place_y[chosen]
+
+        i, j = self.place_x[chosen] - self.x[movers], self.place_y[chosen] - self.y[movers]
+
+        # Already next to the place so no route is made
+        routed = (i != 0) | (j != 0)
+        self.routing[movers] = routed
+        self.target[movers] = np.where(routed, chosen, -1)
+        self.vx[movers[routed]], self.vy[movers[routed]] = kernels.velocity(i[routed], j[routed])
+
+    def __migration_events(self) -> None:
+        '''
+        Moves migrants to a random location in a community picked by the
+        migration network, all in one batch.
+        '''
+        migrants = self.__pick(config.sim.migration, self.__idle(), np.ones(self.limit_x.shape[0], dtype=bool))
+        if migrants.shape[0] == 0:
+            return
+
+        # Destinations are picked within the migrant's own replicate
+        communities = self.group[migrants] % self.communities
+        destinations = np.array([self.networks[r].destination(c, self.rng)
+                for c, r in zip(communities, self.replicate[migrants])], dtype=object)
+        moving = destinations != None
+        migrants = migrants[moving]
+        if migrants.shape[0] == 0:
+            return
+
+        group = (destinations[moving].astype(np.int32) + self.replicate[migrants] * self.communities).astype(np.int32)
+        self.group[migrants] = group
+        # Drawn in whole pixels like the initial positions
+        self.x[migrants] = self.rng.integers(1, (self.limit_x[group] >> kernels.FIXED) + 1) << kernels.FIXED
+        self.y[migrants] = self.rng.integers(1, (self.limit_y[group] >> kernels.FIXED) + 1) << kernels.FIXED
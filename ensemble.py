@@ -0,0 +1,80 @@
+# Uncertainty bands from many stochastic replicates of the same configuration.
+#
+# All replicates are stepped together by a single engine.Engine, so the fixed
+# cost of a cycle is paid once for the whole ensemble.
+#
+# Usage: python ensemble.py [config.json] [replicates] [cycles] [output.csv]
+#
+# The epidemic metrics of each replicate at the end of the run, see
+# analytics.py, are written next to the output as output.metrics.csv.
+import os, sys
+import numpy as np
+
+import config, analytics
+
+
+# Order of the counts returned by engine.Engine.counts()
+COLUMNS = ("susceptible", "infected", "immune", "dead")
+
+
+def summarise(history: np.ndarray, quantiles: list) -> tuple:
+    '''
+    Reduces the trajectories of an ensemble to its mean and quantile bands.
+
+    Arguments:
+        history: (cycles, replicates, 4) array from engine.Engine.run()
+        quantiles: quantiles to compute, e.g. [0.05, 0.95]
+
+    Returns:
+        (mean, bands), mean is a (cycles, 4) array and bands a
+        (len(quantiles), cycles, 4) array
+    '''
+    return history.mean(axis=1), np.quantile(history, quantiles, axis=1)
+
+
+def write_csv(path: str, mean: np.ndarray, bands: np.ndarray, quantiles: list) -> None:
+    '''
+    Writes the mean and quantile bands of every counter, one row per cycle.
+    '''
+    header = ["tick"]
+    header += [f'{column}_mean' for column in COLUMNS]
+    header += [f'{column}_q{q:g}' for q in quantiles for column in COLUMNS]
+
+    rows = np.column_stack([np.arange(mean.shape[0]), mean] + list(bands))
+    np.savetxt(path, rows, delimiter=",", header=",".join(header), comments="", fmt="%g")
+
+
+def write_metrics(path: str, metrics: dict) -> None:
+    '''
+    Writes the epidemic metrics of every replicate, one row per replicate.
+
+    Arguments:
+        path: path of the csv file
+        metrics: analytics.Analytics.snapshot() of the ensemble
+    '''
+    header = ["replicate"] + list(analytics.METRICS)
+    columns = [metrics[name] for name in analytics.METRICS]
+
+    rows = np.column_stack([np.arange(columns[0].shape[0])] + columns)
+    np.savetxt(path, rows, delimiter=",", header=",".join(header), comments="", fmt="%g")
+
+
+if __name__ == "__main__":
+
+    config_addr = sys.argv[1] if len(sys.argv) > 1 else "config.json"
+    config.load(config_addr, show_menu=False)
+
+    replicates = int(sys.argv[2]) if len(sys.argv) > 2 else config.ensemble.get("replicates", 32) or 32
+    cycles = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    output = sys.argv[4] if len(sys.argv) > 4 else "ensemble.csv"
+    quantiles = config.ensemble.get("quantiles", [0.05, 0.95])
+
+    import engine
+
+    ensemble = engine.Engine(replicates=replicates)
+    history = ensemble.run(cycles)
+    mean, bands = summarise(history, quantiles)
+    write_csv(output, mean, bands, quantiles)
+    write_metrics(os.path.splitext(output)[0] + ".metrics.csv", ensemble.analytics.snapshot())
+
+    print(f'{replicates} replicates of {cycles} cycles written to {output}')
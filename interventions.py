@@ -0,0 +1,202 @@
+# Timeline of mitigations applied to a running simulation.
+#
+# Interventions are listed under "interventions" in config.json, for example:
+#
+#   {"action": "close_places", "tick": 600, "duration": 1200, "communities": [0, 1]}
+#   {"action": "cut_migration", "infected": 150}
+#   {"action": "quarantine", "tick": 0, "detection": 0.02}
+#   {"action": "vaccinate", "infected": 50, "rate": 2}
+#
+# An intervention starts once stats.tick reaches "tick" or stats.infected
+# exceeds "infected", and is lifted "duration" cycles later if given.
+# "communities" are indices into the layout read row by row, and default
+# to every community.
+import random
+
+import config
+
+
+ACTIONS = ("cut_migration", "close_places", "quarantine", "vaccinate")
+
+# Settings of an entry that are whole numbers of at least 0
+COUNTS = ("tick", "infected", "duration", "rate")
+
+
+def _whole(value) -> bool:
+    '''
+    Returns whether a value read from JSON is a whole number of at least 0,
+    bool is a subclass of int but never a valid setting.
+    '''
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+class Intervention:
+    '''
+    Purpose: A single entry of the interventions timeline.
+
+    Args:
+        entry: dict read from config.json
+    '''
+
+    def __init__(self, entry: dict) -> None:
+
+        self.action = entry.get("action")
+        if self.action not in ACTIONS:
+            raise ValueError(f'Unknown intervention action: {self.action}')
+        self.__check(entry)
+
+        # Triggers, whichever is reached first starts the intervention
+        self.tick = entry.get("tick")
+        self.infected = entry.get("infected")
+        if self.tick is None and self.infected is None:
+            raise ValueError(f'Intervention {self.action} has no "tick" or "infected" trigger')
+
+        # Number of cycles the intervention lasts, None lasts until the end
+        self.duration = entry.get("duration")
+        self.communities = entry.get("communities")
+
+        # Chance per cycle an infected person is detected and quarantined
+        self.detection = entry.get("detection", 0.01)
+        # Number of people vaccinated per cycle
+        self.rate = entry.get("rate", 1)
+
+        self.started = None
+        self.lifted = False
+
+    @staticmethod
+    def __check(entry: dict) -> None:
+        '''
+        Raises ValueError for settings of the wrong type or out of range, so
+        a bad entry is refused before it reaches the simulation.
+        '''
+        for name in COUNTS:
+            if entry.get(name) is not None and not _whole(entry[name]):
+                raise ValueError(f'Intervention {name} must be a whole number of at least 0, got {entry[name]!r}')
+
+        detection = entry.get("detection", 0)
+        if isinstance(detection, bool) or not isinstance(detection, (int, float)) or not 0 <= detection <= 1:
+            raise ValueError(f'Intervention detection must be a number from 0 to 1, got {detection!r}')
+
+        communities = entry.get("communities")
+        if communities is not None:
+            count = sum(len(row) for row in config.sim.layout)
+            if not isinstance(communities, list) or not all(_whole(i) and i < count for i in communities):
+                raise ValueError(f'Intervention communities must be a list of indices below {count}, got {communities!r}')
+
+    def triggered(self, stats) -> bool:
+        '''
+        Returns whether the intervention should start this cycle.
+        '''
+        if self.tick is not None and stats.tick >= self.tick:
+            return True
+        if self.infected is not None and stats.infected > self.infected:
+            return True
+        return False
+
+    def expired(self, stats) -> bool:
+        '''
+        Returns whether the intervention should be lifted this cycle.
+        '''
+        return self.duration is not None and stats.tick >= self.started + self.duration
+
+    def targets(self, communities: list) -> list:
+        '''
+        Returns the communities the intervention applies to.
+        '''
+        if self.communities is None:
+            return communities
+        return [communities[i] for i in self.communities]
+
+
+class Timeline:
+    '''
+    Purpose: Starts and lifts interventions as the simulation progresses.
+
+    Interventions only flip switches on communities and places when they
+    start or end, so the cost of an active policy each cycle is a flag
+    check inside the passes the simulation already makes.
+
+    Args:
+        entries: list of dicts read from config.json
+    '''
+
+    def __init__(self, entries: list) -> None:
+
+        self.pending = [Intervention(entry) for entry in entries]
+        self.active = []
+
+    def add(self, entry: dict) -> None:
+        '''
+        Schedules another intervention on a running simulation.
+
+        Arguments:
+            entry: dict in the same form as the entries of config.json
+        '''
+        self.pending.append(Intervention(entry))
+
+    def update(self, simulation, stats) -> None:
+        '''
+        Starts and lifts interventions, then applies vaccinations for this cycle.
+
+        Arguments:
+            simulation: Simulation()
+            stats: Stats()
+        '''
+
+        for intervention in [i for i in self.pending if i.triggered(stats)]:
+            self.pending.remove(intervention)
+            intervention.started = stats.tick
+            self.active.append(intervention)
+            self.__apply(intervention, simulation, True)
+
+        for intervention in [i for i in self.active if i.expired(stats)]:
+            self.active.remove(intervention)
+            intervention.lifted = True
+            self.__apply(intervention, simulation, False)
+
+        for intervention in self.active:
+            if intervention.action == "vaccinate":
+                self.__vaccinate(simulation, intervention.targets(simulation.communities), intervention.rate)
+
+    def __apply(self, intervention: Intervention, simulation, start: bool) -> None:
+        '''
+        Switches an intervention on or off for the communities it targets.
+        '''
+        communities = intervention.targets(simulation.communities)
+
+        if intervention.action == "cut_migration":
+            indices = [community.index for community in communities]
+            if start:
+                simulation.network.block(indices)
+            else:
+                simulation.network.unblock(indices)
+
+        elif intervention.action == "close_places":
+            for community in communities:
+                if start:
+                    community.close_places()
+                else:
+                    community.open_places()
+
+        elif intervention.action == "quarantine":
+            for community in communities:
+                if start:
+                    community.quarantine(intervention.detection)
+                else:
+                    community.release(intervention.detection)
+
+    @staticmethod
+    def __vaccinate(simulation, communities: list, rate: int) -> None:
+        '''
+        Vaccinates up to rate susceptible people drawn from the communities at once.
+        '''
+        pool = [person for community in communities for person in community.susceptible]
+
+        for person in random.sample(pool, min(rate, len(pool))):
+            person.vaccinate()
+
+            # People may have migrated since the list was made, their community
+            # is redrawn when dormant and counts them in their new state
+            community = simulation.communities[person.community]
+            community.stale = True
+            community.bin(person)
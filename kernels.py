@@ -0,0 +1,410 @@
+# Per-cycle kernels of the array engine.
+#
+# Movement and the neighbour search of the infection pass are loops full of
+# branches, which NumPy handles poorly. When numba is installed they are JIT
+# compiled from the plain loops below, otherwise the vectorised NumPy versions
+# are used. Both backends consume the same random draws and give identical
+# results for the same seed, run `python kernels.py [config.json] [cycles]`
+# to compare them, and `python regression.py check` to test the backends
+# against golden trajectories.
+#
+# Positions, destinations and velocities are int32 fixed point numbers with
+# FIXED fractional bits, so movement and the catchment test are integer
+# arithmetic and grid cells are found with a shift.
+import math
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# Kernel backends, numba only where it is installed
+BACKENDS = ("numpy", "numba")
+
+# Person states
+SUSCEPTIBLE = 0
+INFECTED = 1
+IMMUNE = 2
+DEAD = 3
+
+# Person behaviour, matching the Person class, in pixels
+MOVEMENT = 2
+SIZE = 5
+STAY_TIME = 100
+# Distance from a destination a person counts as having arrived
+ARRIVAL = 10
+
+# Fractional bits of positions, a unit is 1/256 of a pixel
+FIXED = 8
+SCALE = 1 << FIXED
+
+# Step and arrival distance in fixed point units
+STEP = MOVEMENT * SCALE
+REACH = ARRIVAL * SCALE
+
+
+def to_fixed(pixels) -> np.ndarray:
+    '''
+    Converts positions in pixels to int32 fixed point.
+    '''
+    return np.floor(np.asarray(pixels, dtype=np.float64) * SCALE + 0.5).astype(np.int32)
+
+
+def velocity(i, j) -> tuple:
+    '''
+    Returns the fixed point velocity of a step along the vector (i, j),
+    also in fixed point, rounded to the nearest unit. The vector must not be zero.
+    '''
+    # Worked out in float64, i * STEP overflows int32 on wide worlds
+    i = np.asarray(i, dtype=np.float64)
+    j = np.asarray(j, dtype=np.float64)
+    magnitude = np.sqrt(i ** 2 + j ** 2)
+    return (np.floor(i * STEP / magnitude + 0.5).astype(np.int32),
+            np.floor(j * STEP / magnitude + 0.5).astype(np.int32))
+
+
+def _return_home(i, x, y, routing, dest_x, dest_y, vx, vy, home_x, home_y, has_home, stay, target, place):
+    '''
+    Leaves the current place and routes person i back home.
+    '''
+    stay[i] = STAY_TIME
+    place[i] = -1
+    target[i] = -1
+
+    i_, j_ = float(home_x[i] - x[i]), float(home_y[i] - y[i])
+    magnitude = math.sqrt(i_ * i_ + j_ * j_)
+
+    # Already next to home so no route is made
+    if magnitude == 0:
+        routing[i] = False
+    else:
+        routing[i] = True
+        dest_x[i] = home_x[i]
+        dest_y[i] = home_y[i]
+        vx[i] = math.floor(i_ * STEP / magnitude + 0.5)
+        vy[i] = math.floor(j_ * STEP / magnitude + 0.5)
+
+    has_home[i] = False
+
+
+def _move_loop(x, y, state, quarantined, routing, dest_x, dest_y, vx, vy, home_x, home_y,
+        has_home, stay, target, place, place_open, limit_x, limit_y, group, steps):
+    '''
+    Moves everyone one cycle, see move().
+    '''
+    for i in range(x.shape[0]):
+
+        if state[i] == DEAD or quarantined[i]:
+            continue
+
+        # Random walk clamped to the community
+        if not routing[i]:
+            nx = x[i] + (2 * steps[0, i] - 1) * STEP
+            ny = y[i] + (2 * steps[1, i] - 1) * STEP
+            lx = limit_x[group[i]]
+            ly = limit_y[group[i]]
+
+            if nx < 0:
+                nx = 0
+            elif nx > lx:
+                nx = lx
+            if ny < 0:
+                ny = 0
+            elif ny > ly:
+                ny = ly
+
+            x[i] = nx
+            y[i] = ny
+            continue
+
+        dx = dest_x[i]
+        dy = dest_y[i]
+
+        if abs(dx - x[i]) < REACH and abs(dy - y[i]) < REACH:
+
+            if stay[i] == 0:
+                # Back home after visiting a place
+                if not has_home[i]:
+                    routing[i] = False
+                    stay[i] = STAY_TIME
+                else:
+                    _return_home(i, x, y, routing, dest_x, dest_y, vx, vy,
+                            home_x, home_y, has_home, stay, target, place)
+
+            else:
+                # Enter the place on arrival, unless it closed on the way
+                if target[i] >= 0 and place[i] < 0:
+                    if place_open[target[i]]:
+                        place[i] = target[i]
+                    else:
+                        _return_home(i, x, y, routing, dest_x, dest_y, vx, vy,
+                                home_x, home_y, has_home, stay, target, place)
+                stay[i] -= 1
+
+            x[i] = dx
+            y[i] = dy
+
+        else:
+            x[i] += vx[i]
+            y[i] += vy[i]
+
+
+def _return_home_numpy(i, x, y, routing, dest_x, dest_y, vx, vy, home_x, home_y, has_home, stay, target, place):
+    '''
+    Vectorised _return_home() over an index array.
+    '''
+    stay[i] = STAY_TIME
+    place[i] = -1
+    target[i] = -1
+
+    i_, j_ = home_x[i] - x[i], home_y[i] - y[i]
+
+    # Already next to home so no route is made
+    routed = (i_ != 0) | (j_ != 0)
+    routing[i] = routed
+
+    r = i[routed]
+    dest_x[r] = home_x[r]
+    dest_y[r] = home_y[r]
+    vx[r], vy[r] = velocity(i_[routed], j_[routed])
+
+    has_home[i] = False
+
+
+def _move_numpy(x, y, state, quarantined, routing, dest_x, dest_y, vx, vy, home_x, home_y,
+        has_home, stay, target, place, place_open, limit_x, limit_y, group, steps):
+    '''
+    Moves everyone one cycle, see move().
+    '''
+    active = (state != DEAD) & ~quarantined
+    route = (home_x, home_y, has_home, stay, target, place)
+
+    # Random walk clamped to the community
+    walkers = np.flatnonzero(active & ~routing)
+    g = group[walkers]
+    x[walkers] = np.clip(x[walkers] + (2 * steps[0, walkers].astype(np.int32) - 1) * STEP, 0, limit_x[g])
+    y[walkers] = np.clip(y[walkers] + (2 * steps[1, walkers].astype(np.int32) - 1) * STEP, 0, limit_y[g])
+
+    travellers = np.flatnonzero(active & routing)
+    dx = dest_x[travellers]
+    dy = dest_y[travellers]
+    arrived = (np.abs(dx - x[travellers]) < REACH) & (np.abs(dy - y[travellers]) < REACH)
+
+    moving = travellers[~arrived]
+    x[moving] += vx[moving]
+    y[moving] += vy[moving]
+
+    here = travellers[arrived]
+    leaving = here[stay[here] == 0]
+    staying = here[stay[here] != 0]
+
+    # Back home after visiting a place
+    home = leaving[~has_home[leaving]]
+    routing[home] = False
+    stay[home] = STAY_TIME
+
+    _return_home_numpy(leaving[has_home[leaving]], x, y, routing, dest_x, dest_y, vx, vy, *route)
+
+    # Enter the place on arrival, unless it closed on the way
+    entering = staying[(target[staying] >= 0) & (place[staying] < 0)]
+    is_open = place_open[target[entering]]
+    place[entering[is_open]] = target[entering[is_open]]
+    _return_home_numpy(entering[~is_open], x, y, routing, dest_x, dest_y, vx, vy, *route)
+    stay[staying] -= 1
+
+    x[here] = dx[arrived]
+    y[here] = dy[arrived]
+
+
+def _contacts_loop(x, y, sus, sus_keys, infected, keys, offsets, reach):
+    '''
+    Counts the infected within catchment of each susceptible, see contacts().
+    '''
+    counts = np.zeros(sus.shape[0], dtype=np.int32)
+
+    for n in range(sus.shape[0]):
+        i = sus[n]
+
+        for offset in offsets:
+            key = sus_keys[n] + offset
+            # Run of infected in the neighbouring cell
+            start = np.searchsorted(keys, key, side="left")
+            end = np.searchsorted(keys, key, side="right")
+
+            for m in range(start, end):
+                j = infected[m]
+                if abs(x[i] - x[j]) <= reach and abs(y[i] - y[j]) <= reach:
+                    counts[n] += 1
+
+    return counts
+
+
+def _contacts_numpy(x, y, sus, sus_keys, infected, keys, offsets, reach):
+    '''
+    Counts the infected within catchment of each susceptible, see contacts().
+    '''
+    counts = np.zeros(sus.shape[0], dtype=np.int32)
+    owners = np.arange(sus.shape[0])
+
+    for offset in offsets:
+        neighbours = sus_keys + offset
+        start = np.searchsorted(keys, neighbours, side="left")
+        runs = np.searchsorted(keys, neighbours, side="right") - start
+
+        total = runs.sum()
+        if total == 0:
+            continue
+
+        # Expand every susceptible into one row per infected in the neighbouring cell
+        owner = np.repeat(owners, runs)
+        position = np.repeat(start - np.cumsum(runs) + runs, runs) + np.arange(total)
+        i = sus[owner]
+        j = infected[position]
+
+        close = (np.abs(x[i] - x[j]) <= reach) & (np.abs(y[i] - y[j]) <= reach)
+        counts += np.bincount(owner[close], minlength=sus.shape[0]).astype(np.int32)
+
+    return counts
+
+
+def contacts(x, y, group, sus, infected, catchment, width) -> np.ndarray:
+    '''
+    Counts how many infected people are within catchment (Manhattan style box,
+    as in Pathogen.infect) of each susceptible person in the same community.
+    People are bucketed into a grid per community of cells a power of two
+    units across and at least catchment wide, so cells are found with a shift
+    and each susceptible only checks the infected in the 9 cells around it.
+
+    Arguments:
+        x, y: fixed point positions of everyone
+        group: community index of everyone
+        sus: indices of the susceptible people to count contacts for
+        infected: indices of the infectious people
+        catchment: pathogen catchment in pixels
+        width: largest community width in fixed point, used to lay out the grid keys
+
+    Returns:
+        number of contacts of each person in sus
+    '''
+    if sus.shape[0] == 0 or infected.shape[0] == 0:
+        return np.zeros(sus.shape[0], dtype=np.int32)
+
+    reach = int(to_fixed(catchment))
+    # Cells are 2^shift units across, the smallest power of two above reach
+    shift = max(reach, 1).bit_length()
+    # Columns are offset by one so neighbouring cells never wrap into another row or community
+    columns = (int(width) >> shift) + 3
+    rows = (int(max(y[sus].max(), y[infected].max())) >> shift) + 3
+
+    def key(people):
+        cx = (x[people] >> shift).astype(np.int64) + 1
+        cy = (y[people] >> shift).astype(np.int64) + 1
+        return (group[people].astype(np.int64) * rows + cy) * columns + cx
+
+    infected_keys = key(infected)
+    order = np.argsort(infected_keys, kind="stable")
+    offsets = np.array([dy * columns + dx for dy in (-1, 0, 1) for dx in (-1, 0, 1)], dtype=np.int64)
+
+    return _contacts(x, y, sus, key(sus), infected[order], infected_keys[order], offsets, reach)
+
+
+def move(x, y, state, quarantined, routing, dest_x, dest_y, vx, vy, home_x, home_y,
+        has_home, stay, target, place, place_open, limit_x, limit_y, group, steps) -> None:
+    '''
+    Moves everyone one cycle in place, following the rules of Person.update:
+    people without a destination take a random step, travellers walk along
+    their velocity, and on arrival stay at a place for STAY_TIME cycles before
+    walking home.
+
+    Arguments:
+        steps: (2, n) array of 0 or 1, the direction of each random step
+        limit_x, limit_y: furthest fixed point position in each community
+        everything else: per person arrays of the engine, see engine.Engine
+    '''
+    _move(x, y, state, quarantined, routing, dest_x, dest_y, vx, vy, home_x, home_y,
+            has_home, stay, target, place, place_open, limit_x, limit_y, group, steps)
+
+
+def return_home(people, x, y, routing, dest_x, dest_y, vx, vy, home_x, home_y,
+        has_home, stay, target, place) -> None:
+    '''
+    Sends people out of their place and back home, see Person.return_home.
+
+    Arguments:
+        people: index array of the people
+        everything else: per person arrays of the engine, see engine.Engine
+    '''
+    _return_home_numpy(people, x, y, routing, dest_x, dest_y, vx, vy, home_x, home_y,
+            has_home, stay, target, place)
+
+
+def use(backend: str) -> None:
+    '''
+    Selects the kernels used, "numba" or "numpy".
+    '''
+    global BACKEND, _move, _contacts
+
+    if backend == "numba":
+        if numba is None:
+            raise ImportError("numba is not installed")
+        _move, _contacts = _move_numba, _contacts_numba
+    elif backend == "numpy":
+        _move, _contacts = _move_numpy, _contacts_numpy
+    else:
+        raise ValueError(f'Unknown kernel backend: {backend}')
+
+    BACKEND = backend
+
+
+if numba is not None:
+    _return_home = numba.njit(cache=True)(_return_home)
+    _move_numba = numba.njit(cache=True)(_move_loop)
+    _contacts_numba = numba.njit(cache=True)(_contacts_loop)
+    use("numba")
+else:
+    use("numpy")
+
+
+def check(ticks=200, seed=0) -> bool:
+    '''
+    Runs engine.Engine on the loaded configuration with each backend and
+    returns whether the histories and final positions match exactly.
+
+    Raises:
+        ImportError: when numba is not installed and there is nothing to compare
+    '''
+    import engine
+
+    if numba is None:
+        raise ImportError("numba is not installed")
+
+    results = []
+    for backend in ("numpy", "numba"):
+        use(backend)
+        # Every cycle is simulated, no replicate is retired early
+        simulation = engine.Engine(seed)
+        history = simulation.run(ticks, {"extinct": False})
+        results.append((history, simulation.x, simulation.y))
+
+    use("numba")
+
+    return all(np.array_equal(a, b) for a, b in zip(*results))
+
+
+if __name__ == "__main__":
+
+    import sys, config
+
+    config_addr = sys.argv[1] if len(sys.argv) > 1 else "config.json"
+    ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    config.load(config_addr, show_menu=False)
+
+    if numba is None:
+        print("SKIP numba is not installed, only the numpy kernels are available. "
+                "python regression.py check tests them against the golden trajectories")
+    elif not check(ticks):
+        sys.exit("Backends differ")
+    else:
+        print("Backends match")
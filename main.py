@@ -1,7 +1,8 @@
 # Author: Isaac Beight-Welland
 # A simple pandemic simulation created in pygame.
 # Made for AQA A level Computer Science NEA 2021/22
-import pygame, random, time, math, render, config
+import pygame, os, random, time, math, render, config, interventions, migration, tracing, engine, control, scenario, viewport, analytics, recorder
+import numpy as np
 
 from dataclasses import dataclass
 
@@ -25,8 +26,14 @@ class Pathogen:
         self.lethality = config.pathogen.lethality
         # The rate at which the probability of someone being cured from the disease increases every cycle
         self.curability = config.pathogen.curability
-
-    def infect(self, susceptible, infected) -> None:
+        # Chance per cycle an infected occupant of a place infects another occupant
+        self.place_infectiousness = config.pathogen.place_infectiousness
+        # Cycles a cured person stays immune for, 0 means immunity never wanes
+        self.immunity = config.pathogen.immunity
+        # People losing immunity, bucketed by the cycle they become susceptible again
+        self.waning = {}
+
+    def infect(self, susceptible, infected, community: int) -> None:
         '''
         Purpose: Given two people who have been in contact;
         returns whether the infected person infects the other 'person'
@@ -34,6 +41,7 @@ class Pathogen:
         Arguments:
             susceptible: Person()
             infected: Person()
+            community: index of the community they are in
         '''
 
         if susceptible.infected == True:
@@ -41,13 +49,40 @@ class Pathogen:
         if infected.infected == False:
             return
 
-        sx, sy = susceptible.coords
-        ix, iy = infected.coords
+        within = (abs(susceptible.x - infected.x) <= self.catchment
+                and abs(susceptible.y - infected.y) <= self.catchment)
+        if within and tracer.contacts != None:
+            tracer.contact(infected, susceptible, community)
 
         if random.random() < self.infectiousness:
 
-            if abs(sx - ix) <= self.catchment and abs(sy - iy) <= self.catchment:
-                susceptible.infect()
+            if within:
+                susceptible.infect(infected, community)
+
+
+    def infect_place(self, place, community: int) -> None:
+        '''
+        Spreads the pathogen between the occupants of a place. Everyone inside
+        is in contact with everyone else, so a susceptible occupant escapes
+        each infected occupant independently and the pass only visits the
+        occupants.
+
+        Arguments:
+            place: Place()
+            community: index of the community the place is in
+        '''
+
+        infected = [person for person in place.occupants if person.infected]
+        if len(infected) == 0:
+            return
+
+        # Chance of not being infected by any of the infected occupants
+        escape = (1 - self.place_infectiousness) ** len(infected)
+
+        for person in place.occupants:
+            if person.infected == False and random.random() >= escape:
+                # Every infected occupant is equally likely to be the source
+                person.infect(random.choice(infected), community, place.index)
 
 
     def update_health(self, person):
@@ -60,6 +95,7 @@ class Pathogen:
 
         if random.random() < self.curability:
             person.cure(True)
+            self.schedule_waning(person)
             return
         else:
             person.cure_chance += self.curability
@@ -71,6 +107,36 @@ class Pathogen:
             person.death_chance += self.lethality
 
 
+    def schedule_waning(self, person) -> None:
+        '''
+        Books the cycle at which a newly immune person becomes susceptible again.
+
+        Arguments:
+            person : Person()
+        '''
+        if self.immunity == 0:
+            return
+
+        self.waning.setdefault(stats.tick + self.immunity, []).append(person)
+
+
+    def wane(self) -> list:
+        '''
+        Returns everyone whose immunity expires this cycle to being susceptible.
+        Only the bucket for the current cycle is visited, so the cost of a cycle
+        is proportional to the number of people losing immunity.
+
+        Returns:
+            list of the people who became susceptible, people of the bucket
+            who died since are left out
+        '''
+        waning = [person for person in self.waning.pop(stats.tick, []) if person.immune == True and person.dead == False]
+        for person in waning:
+            person.lose_immunity()
+
+        return waning
+
+
 class Graph:
 
     '''
@@ -122,6 +188,16 @@ class Graph:
             tuple(config.theme.immune) : [stats.immune]
         }
 
+        # Ensemble (low, high) quantiles shaded behind each line
+        self.bands = {colour: [] for colour in self.values}
+        # Column of each line in engine counts
+        self.columns = {
+            tuple(config.theme.susceptible) : 0,
+            tuple(config.theme.infected) : 1,
+            tuple(config.theme.immune) : 2,
+            tuple(config.theme.dead) : 3
+        }
+
     def plot(self) -> None:
         '''
         Add values to be plotted to the graph; the value parameter is a
@@ -134,6 +210,21 @@ class Graph:
         self.values[tuple(config.theme.immune)].append(stats.immune)
 
 
+    def shade(self, counts, quantiles: list) -> None:
+        '''
+        Adds the spread of an ensemble at the latest cycle, drawn as a shaded
+        band around each line.
+
+        Arguments:
+            counts: (replicates, 4) array from engine.Engine.counts()
+            quantiles: [low, high] quantiles bounding the band
+        '''
+        low, high = np.quantile(counts, quantiles, axis=0)
+
+        for colour, column in self.columns.items():
+            self.bands[colour].append((low[column], high[column]))
+
+
     def __draw_axis(self) -> None:
 
         self.y_max = config.sim.population
@@ -163,6 +254,24 @@ class Graph:
         self.x_scale = (self.width-self.e_buff-self.w_buff)/self.x_max
 
 
+    def __draw_bands(self) -> None:
+
+        for (colour, band) in self.bands.items():
+
+            # A polygon needs at least two cycles on each edge
+            if len(band) < 2:
+                continue
+
+            upper = []
+            lower = []
+            for point_count, (low, high) in enumerate(band):
+                x_pos = round(self.w_buff + (self.x_scale * point_count) + (self.x_scale / 2))
+                upper.append((x_pos, round((self.height - self.s_buff) - (self.y_scale * high))))
+                lower.append((x_pos, round((self.height - self.s_buff) - (self.y_scale * low))))
+
+            render.alpha_polygon(self.surf, (*colour, 60), upper + lower[::-1])
+
+
     def __draw_plots(self) -> None:
 
         # Plot points for each line
@@ -197,6 +306,7 @@ class Graph:
         self.surf.blit(self.title, (self.w_buff, self.height-self.s_buff))
 
         self.__draw_axis()
+        self.__draw_bands()
         self.__draw_plots()
 
 @dataclass
@@ -208,7 +318,8 @@ class Stats:
     susceptible = config.sim.susceptible
     dead = config.sim.dead
     immune = config.sim.immune
-    old_infected = 1 # Used to calculate r number
+    tick = 0 # Number of cycles simulated
+    infections = 0 # Number of infections since the start, counting reinfections
 
 
 class Simulation:
@@ -216,14 +327,29 @@ class Simulation:
     Controls the main pygame window, has Communnity instances as frames
 
     Args:
-        config: str path of config.json
+        offscreen: draw without a window and as fast as possible, only the
+            cycles the recorder captures are drawn, see recorder.py
     '''
 
-    def __init__(self) -> None:
+    def __init__(self, offscreen=False) -> None:
 
         global stats, pathogen
 
-        self.communities = self.__calc_communities()
+        self.communities = create_communities()
+        # The pixels between each row of communities
+        self.y_buffer = scenario.current().y_buffer
+
+        # Growth, size, peak and end of the epidemic, updated every cycle
+        self.analytics = analytics.Analytics(config.sim.population)
+
+        # Camera the window looks at the world of communities through
+        self.camera = viewport.Camera(scenario.current().world_size, config.app.sim_size)
+        # Draw communities as density maps of each state instead of person by person
+        self.heatmap = config.app.render == "heatmap"
+
+        # Network migrants travel along and the mitigation timeline
+        self.network = migration.Network(config.sim.layout, config.sim.topology)
+        self.timeline = interventions.Timeline(config.interventions)
 
         # Create application
         window_size = (config.app.sim_size[0] + config.app.sidebar_width, config.app.sim_size[1] + config.app.bar_height)
@@ -244,65 +370,155 @@ class Simulation:
         # Create graph to be rendered in sidebar
         self.graph = Graph((config.app.sidebar_width, config.app.sim_size[1]//2), self.font)
 
+        # Replicates of the same configuration stepped alongside the live run for uncertainty bands
+        self.ensemble = None
+        if config.ensemble.get("replicates", 0) > 0:
+            self.ensemble = engine.Engine(replicates=config.ensemble["replicates"])
+            self.graph.shade(self.ensemble.counts(), config.ensemble.get("quantiles", [0.05, 0.95]))
+
         # Define the frame rate of simulation, depending on speed
         self.delay = 0.016
+        self.paused = False
         self.speed_states = {
             0.008 : render.fast_symbol,
             0.016: render.normal_speed_symbol,
             0.064: render.slow_symbol}
 
-    def __calc_communities(self) -> list:
+        # Server taking commands and streaming stats over localhost
+        self.control = None
+        if config.control.get("enabled", False):
+            self.control = control.Server(config.control)
+            self.control.start()
+
+        # Frames of the window written to disk as the simulation runs
+        self.recorder = None
+        if config.record.get("enabled", False):
+            self.recorder = recorder.Recorder(config.record, window_size)
+            self.recorder.start()
+        self.offscreen = offscreen
+
+    def __migrate(self, migrants: list) -> None:
         '''
-        Initialises communities according to config file.
+        Moves the migrants of a cycle to their new communities in one batch.
 
-        Returns:
-            list of community objects.
+        Arguments:
+            migrants: list of (Person(), Community()) the person is leaving
         '''
-        communities = []
-        sim_width, sim_height = config.app.sim_size
-        layout = config.sim.layout
-        self.y_buffer = sim_height/(len(layout)*10) # The pixels between each row of communities
-        height = round((sim_height - (self.y_buffer*(len(layout)+1))) / len(layout))
+        departures = {}
+        arrivals = {}
+
+        for person, community in migrants:
 
-        # Create each community in grid defined by layout
-        for y, cols in enumerate(layout):
+            index = self.network.destination(community.index)
+            if index == None:
+                continue
 
-            x_buffer = sim_width/(len(cols)*10)
+            new_community = self.communities[index]
+            person.community = index
+            person.community_size = new_community.surf_size
+            person.set_random_location()
 
-            width = round((sim_width - (x_buffer*(len(cols)+1))) / len(cols))
-            for x, (pop, places) in enumerate(cols):
+            departures.setdefault(community, []).append(person)
+            arrivals.setdefault(new_community, []).append(person)
 
-                coords = round((x*(width+x_buffer)+x_buffer)), round(y*(height+self.y_buffer)+self.y_buffer)
-                communities.append(Community(coords, (width, height), pop, places))
+        for community, people in departures.items():
+            leaving = set(people)
+            community.population = [person for person in community.population if person not in leaving]
+            community.stale = True
+            for person in people:
+                community.unbin(person)
+        for community, people in arrivals.items():
+            community.population.extend(people)
+            community.stale = True
+            for person in people:
+                community.bin(person)
 
-        return communities
+            # An infected migrant brings a dormant community back to life
+            if community.dormant == True and any(person.infected for person in people):
+                community.wake()
 
 
     def __pause(self) -> None:
         '''
-        Handles the pause state of the simulation.
+        Handles the pause state of the simulation. Waits on the event queue,
+        so a paused simulation sleeps until a key press or a command.
         '''
-        paused = True
-        while paused:
+        self.paused = True
+        self.__publish()
 
-            # Render Pause bars
-            render.pause_symbol(self.window)
+        # Render Pause bars
+        render.pause_symbol(self.window)
+        pygame.display.update()
+
+        while self.paused and self.running:
 
             # Event handling for pause menu
-            for event in pygame.event.get():
+            event = pygame.event.wait()
 
-                if event.type == pygame.QUIT:
-                    paused = False
+            if event.type == pygame.QUIT:
+                self.running = False
+
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_ESCAPE:
                     self.running = False
+                if event.key == pygame.K_p:
+                    self.paused = False
 
-                if event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_ESCAPE:
-                        self.running = False
-                        paused = False
-                    if event.key == pygame.K_p:
-                        paused = False
+            if event.type == control.EVENT:
+                self.__control(event)
+
+            # Window was uncovered and needs drawing again
+            if event.type == pygame.WINDOWEXPOSED:
+                pygame.display.update()
+
+        self.paused = False
+        self.__publish()
+
+
+    def __control(self, event) -> None:
+        '''
+        Applies a command received by the control server, see control.py.
+        '''
+        if event.command == "pause" and self.paused == False:
+            self.__pause()
+        elif event.command == "resume":
+            self.paused = False
+        elif event.command == "stop":
+            self.running = False
+        elif event.command == "speed":
+            self.delay = event.body["delay"]
+        elif event.command == "pathogen":
+            # The ensemble reads the settings, the live run its Pathogen
+            for name, value in event.body.items():
+                setattr(config.pathogen, name, value)
+                setattr(pathogen, name, value)
+        elif event.command == "interventions":
+            self.timeline.add(event.body)
+            if self.ensemble != None:
+                self.ensemble.schedule(event.body)
+
+
+    def __publish(self) -> None:
+        '''
+        Hands the current stats to the control server, if one is running.
+        '''
+        if self.control == None:
+            return
+
+        snapshot = {
+            "tick": stats.tick,
+            "susceptible": stats.susceptible,
+            "infected": stats.infected,
+            "immune": stats.immune,
+            "dead": stats.dead,
+            "paused": self.paused,
+            "delay": self.delay}
+
+        # JSON has no nan or inf, metrics not known yet are null
+        for name, value in self.analytics.snapshot().items():
+            snapshot[name] = float(value) if np.isfinite(value) else None
 
-            pygame.display.update()
+        self.control.publish(snapshot)
 
 
     def __render_sidebar(self) -> None:
@@ -310,12 +526,9 @@ class Simulation:
         Controls the rendering of the sidebar in pygame window.
         '''
 
-        # Calculate R number
-        try:
-            r = round(1 + (stats.susceptible - stats.infected) / stats.old_infected, 2)
-        except ZeroDivisionError:
-            r = 0
-        stats.old_infected = stats.infected
+        # R number and generation interval from the transmission log
+        r = round(tracer.reproduction(), 2)
+        generation = round(tracer.generation_interval())
 
         # Update counter on label
         infected_label = self.font.render(f'Infected:{stats.infected}', True, config.theme.infected)
@@ -323,6 +536,7 @@ class Simulation:
         dead_label = self.font.render(f'Dead:{stats.dead}', True, config.theme.dead)
         immune_label = self.font.render(f'Immune:{stats.immune}', True, config.theme.immune)
         r_label = self.font.render(f'R:{r}', True, config.theme.r_label)
+        generation_label = self.font.render(f'Generation:{generation}', True, config.theme.r_label)
 
         # Render changes to surface
         self.sidebar_surf.blit(susceptible_label, (0, self.y_buffer))
@@ -330,63 +544,155 @@ class Simulation:
         self.sidebar_surf.blit(dead_label, (0,  self.y_buffer + self.font_size * 2.5))
         self.sidebar_surf.blit(immune_label, (0,  self.y_buffer + self.font_size * 3.75))
         self.sidebar_surf.blit(r_label, (0,  self.y_buffer + self.font_size * 5))
+        self.sidebar_surf.blit(generation_label, (0,  self.y_buffer + self.font_size * 6.25))
+
+    def __render_metrics(self) -> None:
+        '''
+        Renders the epidemic metrics in the bar below the simulation.
+        '''
+        metrics = self.analytics.snapshot()
+
+        def cycles(value):
+            return f'{value:.0f}' if np.isfinite(value) else '-'
+
+        labels = (
+            f'Doubling time:{cycles(metrics["doubling_time"])}  Growth:{np.nan_to_num(metrics["growth_rate"]):+.3f}',
+            f'Attack rate:{metrics["attack_rate"]:.1%}',
+            f'Peak:{metrics["peak"]:.0f} at {metrics["peak_tick"]:.0f}' + ('' if self.analytics.peaked() else ' (rising)'),
+            f'Extinction:{cycles(metrics["extinction"])}')
+
+        for line, label in enumerate(labels):
+            text = self.font.render(label, True, config.theme.susceptible)
+            self.botbar_surf.blit(text, (self.font_size // 2, self.font_size // 2 + self.font_size * 1.25 * line))
+
+    def __warm_start(self, cases) -> None:
+        '''
+        Starts from the case counts of each community, given to random
+        people of the community.
+
+        Arguments:
+            cases: (communities, 3) array from scenario.read_cases()
+        '''
+        for community, (_, infected, immune) in zip(self.communities, cases):
+
+            people = random.sample(community.population, int(infected + immune))
+            for person in people[:infected]:
+                person.infect(None, community.index)
+            # Immune people were infected before the start
+            for person in people[infected:]:
+                person.vaccinate()
+            stats.infections += int(immune)
 
-    def __render_graph(self) -> None:
+    def __render_graph(self, draw: bool) -> None:
         '''
         Controls the rendering and updating of the graph object in sidebar.
+        The graph takes the values of every cycle, drawn or not.
         '''
 
+        # Step the ensemble in lockstep with the live run
+        if self.ensemble != None:
+            self.ensemble.step()
+            self.graph.shade(self.ensemble.counts(), config.ensemble.get("quantiles", [0.05, 0.95]))
+
         # Update graph
         self.graph.plot()
+        if draw == False:
+            return
         self.graph.draw()
         # Draw updated graph to application
         self.sidebar_surf.blit(self.graph.surf, (0, config.app.sim_size[1]//2))
 
 
-    def run(self) -> None:
+    def run(self, ticks=0) -> None:
         '''
         Instantiates pygame window and starts the simulation.
+
+        Args:
+            ticks: cycles to run for, 0 to run until the window is closed
         '''
 
-        # Infect first person
-        self.communities[0].population.sprites()[0].infect()
+        cases = scenario.current().cases
+        if cases is None:
+            # Infect first person
+            self.communities[0].population[0].infect(None, 0)
+        else:
+            self.__warm_start(cases)
 
         self.running = True
         while self.running:
 
-            # Fill backgrounds for re-rendering
-            self.sim_surf.fill(config.theme.appbg)
-            self.sidebar_surf.fill(config.theme.appbg)
-            self.controls_surf.fill(config.theme.appbg)
-            self.botbar_surf.fill(config.theme.appbg)
+            # Advance the clock and release people whose immunity has worn off
+            stats.tick += 1
+            tracer.advance(stats.tick)
+            # A dormant community holds a frame that shows them as immune
+            for person in pathogen.wane():
+                self.communities[person.community].stale = True
+                self.communities[person.community].bin(person)
+
+            # Start, lift and apply interventions due this cycle
+            self.timeline.update(self, stats)
+
+            # Offscreen runs only draw the cycles the recorder keeps
+            draw = self.offscreen == False or (self.recorder != None and self.recorder.due(stats.tick))
+
+            if draw == True:
+                # Fill backgrounds for re-rendering
+                self.sim_surf.fill(config.theme.appbg)
+                self.sidebar_surf.fill(config.theme.appbg)
+                self.controls_surf.fill(config.theme.appbg)
+                self.botbar_surf.fill(config.theme.appbg)
 
-            # Update statistics and graphs
-            self.__render_sidebar()
-            self.__render_graph()
+                # Update statistics
+                self.__render_sidebar()
+                self.__render_metrics()
+            self.__render_graph(draw)
+
+            # Migrants leaving each community this cycle
+            migrants = []
+
+            # People too small to make out are shown as a heat tile of their community
+            detail = self.camera.zoom * Person.size[0] >= viewport.DETAIL
 
             # Update community and render
             for community in self.communities:
 
-                community.surf.fill(config.theme.simbg)
+                # Only communities in view are drawn person by person
+                rect = self.camera.project(community.coords, community.surf_size)
+                visible = self.camera.visible(rect)
+                community.detailed = visible and detail and draw
+                community.heatmap = self.heatmap
 
-                persons_migrated = community.update()
+                # Dormant communities keep their last frame until their population changes
+                redraw = community.detailed and (community.dormant == False or community.stale == True)
+                if redraw and self.heatmap == False:
+                    community.surf.fill(config.theme.simbg)
 
-                # If there is only one community, do not go through with migration process
-                valid = [x for x in self.communities if x is not community]
-                if len(valid) > 0:
-
-                    # Remove migrant from old community and add to new community
-                    for person in persons_migrated:
-                        community.population.remove(person)
-                        person.set_random_location()
-                        new_community = random.choice(valid)
-                        person.community_size = new_community.surf_size
-                        new_community.population.add(person)
+                for person in community.update():
+                    migrants.append((person, community))
 
                 # Draw changes to surface and render to window
-                community.places.draw(community.surf)
-                community.population.draw(community.surf)
-                self.sim_surf.blit(community.surf, community.coords)
+                if redraw:
+                    if self.heatmap == True:
+                        community.draw_heatmap()
+                        community.places.draw(community.surf)
+                    else:
+                        community.places.draw(community.surf)
+                        community.draw_population()
+                    community.stale = False
+                elif community.detailed == False:
+                    community.stale = True
+
+                if community.detailed == True:
+                    if rect.size == community.surf_size:
+                        self.sim_surf.blit(community.surf, rect)
+                    else:
+                        self.sim_surf.blit(pygame.transform.scale(community.surf, rect.size), rect)
+                elif visible == True and draw == True:
+                    self.sim_surf.fill(community.heat(), rect)
+
+            self.__migrate(migrants)
+            self.analytics.update(stats.tick, stats.infected, stats.infections)
+            self.__publish()
 
             # Event handler
             for event in pygame.event.get():
@@ -401,6 +707,11 @@ class Simulation:
                         self.running = False
                     if event.key == pygame.K_p:
                         self.__pause()
+                    if event.key == pygame.K_h:
+                        self.heatmap = not self.heatmap
+                        # Dormant communities hold a frame drawn in the other mode
+                        for community in self.communities:
+                            community.stale = True
                     if event.key == pygame.K_LEFT:
 
                         if self.delay != 0.064:
@@ -415,53 +726,96 @@ class Simulation:
                         else:
                             self.delay = 0.016
 
-            # Render all frames to main window
-            self.window.blit(self.sim_surf, (0, 0))
-            self.window.blit(self.sidebar_surf, (config.app.sim_size[0], 0))
-            self.window.blit(self.controls_surf, (config.app.sim_size))
-            self.window.blit(self.botbar_surf, (0, config.app.sim_size[1]))
-            # Render speed symbol
-            self.speed_states[self.delay](self.window)
-            # Update display
-            pygame.display.update()
-            time.sleep(self.delay) # 60 updates a second
+                # Command from the control server
+                if event.type == control.EVENT:
+                    self.__control(event)
 
+                # Pan and zoom
+                self.camera.handle(event)
 
+            if draw == True:
+                # Render all frames to main window
+                self.window.blit(self.sim_surf, (0, 0))
+                self.window.blit(self.sidebar_surf, (config.app.sim_size[0], 0))
+                self.window.blit(self.controls_surf, (config.app.sim_size))
+                self.window.blit(self.botbar_surf, (0, config.app.sim_size[1]))
+                # Render speed symbol
+                self.speed_states[self.delay](self.window)
 
-class Person(pygame.sprite.Sprite):
+            if self.recorder != None:
+                self.recorder.capture(self.window, stats.tick)
 
-    def __init__(self, community_size) -> None:
+            if self.offscreen == False:
+                # Update display
+                pygame.display.update()
+                time.sleep(self.delay) # 60 updates a second
+            if stats.tick == ticks:
+                self.running = False
+
+        tracer.close()
+        if self.recorder != None:
+            self.recorder.close()
 
-        global stats
 
-        # Initialise sprite to allow rendering
-        pygame.sprite.Sprite.__init__(self)
+
+class Person:
+    '''
+    A single agent. People are plain records with a fixed set of slots and
+    no surface of their own, the community draws them from their state.
+    '''
+
+    __slots__ = (
+        "id", "community", "community_size", "x", "y", "dead", "immune", "infected",
+        "quarantined", "cure_chance", "death_chance", "despawn_time",
+        "infected_at", "infections", "dest", "vx", "vy", "home",
+        "target", "place", "stay_time", "cell",
+    )
+
+    # Number of people created so far, used to give everyone a unique id
+    created = 0
+
+    # Person size when rendered and distance moved every cycle
+    size = (5, 5)
+    movement = 2
+
+    def __init__(self, community_size, community: int) -> None:
+
+        self.id = Person.created
+        Person.created += 1
 
         # Simulation variables
+        self.community = community
         self.community_size = community_size
 
-        # Person size and surface to be rendered
-        self.size = (5,5)
-        self.image = pygame.Surface(self.size)
-        self.image.fill(config.theme.susceptible)
-
         # Person location
-        self.rect = self.image.get_rect()
         self.set_random_location()
 
         # Person behaviour variables
-        self.movement = 2
         self.dead = False
         self.immune = False
         self.infected = False
         self.cure_chance = 0
         self.death_chance = 0
         self.despawn_time = 300 # Equivalent to 5s at 60hz
+        # Cycle the person was last infected and how many people they infected since
+        self.infected_at = 0
+        self.infections = 0
 
         # Route behaviour
         self.dest = None
+        # Velocity towards the destination and where to return to afterwards
+        self.vx = 0
+        self.vy = 0
+        self.home = None
+        # Place the person is heading to and the place they are currently inside
+        self.target = None
+        self.place = None
+        # Detected cases stay where they are and take no part in transmission
+        self.quarantined = False
         # How many cycles the person will stay at the destination
         self.stay_time = 100
+        # Heatmap cell and state the person is counted in, -1 for none, see Community.bin
+        self.cell = -1
 
 
     def kill(self):
@@ -475,33 +829,46 @@ class Person(pygame.sprite.Sprite):
         if self.infected == False:
             return
 
+        # Dead people no longer occupy places
+        self.leave()
+
+        tracer.resolve(self)
+
         # Update person vars
         self.dead = True
         self.infected = False
         self.cure_chance = 0
         self.immune = False
-        self.image.fill(config.theme.dead)
 
         # Update stats
         stats.dead += 1
         stats.infected -= 1
 
 
-    def infect(self):
+    def infect(self, infector, community: int, place: int = -1):
         '''
         Infects a person.
+
+        Arguments:
+            infector: Person() who passed on the infection, None if from outside
+            community: index of the community the infection happened in
+            place: index of the place the infection happened in, -1 if outside
         '''
         # Guard checks to ensure person is infectable
         if self.dead == True:
             return
         if self.immune == True:
             return
+        if self.infected == True:
+            return
 
         self.infected = True
-        self.image.fill(config.theme.infected)
 
         stats.infected += 1
         stats.susceptible -= 1
+        stats.infections += 1
+
+        tracer.infection(infector, self, community, place)
 
 
     def cure(self, immune = False):
@@ -514,38 +881,153 @@ class Person(pygame.sprite.Sprite):
         if self.infected == False:
             return
 
+        tracer.resolve(self)
+
         # Update person state
         self.infected = False
+        self.quarantined = False
+        self.cure_chance = 0
+        self.death_chance = 0
+
+        # Adjust global counters
+        stats.infected -= 1
 
         if immune:
             self.immune = True
-            self.image.fill(config.theme.immune)
+            stats.immune += 1
         else:
-            self.image.fill(config.theme.susceptible)
+            stats.susceptible += 1
 
-        # Adjust global counters
-        stats.infected -= 1
+
+    def lose_immunity(self):
+        '''
+        Returns an immune person to being susceptible.
+        '''
+        # Guard checks to ensure person is immune
+        if self.dead == True:
+            return
+        if self.immune == False:
+            return
+
+        self.immune = False
+
+        stats.immune -= 1
+        stats.susceptible += 1
+
+
+    def vaccinate(self):
+        '''
+        Makes a susceptible person immune without being infected.
+        '''
+        # Guard checks to ensure person is susceptible
+        if self.dead == True:
+            return
+        if self.infected == True or self.immune == True:
+            return
+
+        self.immune = True
+
+        stats.susceptible -= 1
         stats.immune += 1
 
+        pathogen.schedule_waning(self)
+
+
+    def isolate(self):
+        '''
+        Quarantines a detected infected person where they stand.
+        '''
+        if self.infected == False:
+            return
+
+        self.quarantined = True
+        self.leave()
+        self.dest = None
+
+
+    def colour(self) -> tuple:
+        '''
+        Returns the theme colour the person is drawn in.
+        '''
+        if self.dead == True:
+            return config.theme.dead
+        if self.infected == True:
+            return config.theme.infected
+        if self.immune == True:
+            return config.theme.immune
+        return config.theme.susceptible
+
 
     def set_random_location(self) -> None:
         '''
         Move person to random location in commmunity
         '''
-        self.rect.x = random.randint(1,self.community_size[0] - self.size[0])
-        self.rect.y = random.randint(1,self.community_size[1] - self.size[1])
-        self.coords = self.rect.x, self.rect.y
+        self.x = random.randint(1,self.community_size[0] - self.size[0])
+        self.y = random.randint(1,self.community_size[1] - self.size[1])
+
+
+    def visit(self, place) -> None:
+        '''
+        Sends the person to a place, where they stay before walking home.
+
+        Arguments:
+            place: Place()
+        '''
+        self.target = place
+        self.route(place.coords, True)
+
+        # Route could not be made so person never arrives
+        if self.dest == None:
+            self.target = None
+
+
+    def enter(self) -> None:
+        '''
+        Adds person to the occupants of the place they were heading to.
+        '''
+        if self.target == None or self.place != None:
+            return
+
+        # Place closed while the person was on their way
+        if self.target.open == False:
+            self.return_home()
+            return
+
+        self.place = self.target
+        self.place.occupants[self] = None
+
+
+    def leave(self) -> None:
+        '''
+        Removes person from the place they are inside.
+        '''
+        if self.place != None:
+            self.place.occupants.pop(self, None)
+
+        self.place = None
+        self.target = None
+
+
+    def return_home(self) -> None:
+        '''
+        Leaves the current place and walks back home.
+        '''
+        self.stay_time = 100
+        self.leave()
+        self.route(self.home, False)
+
+        self.home = None
 
 
     def route(self, dest: tuple[int,int], set_home: bool) -> None:
 
         # Set a home which can be returned to
         if set_home == True:
-            self.home = self.coords
+            self.home = self.x, self.y
 
         self.dest = dest
 
-        x1, y1 = self.coords
+        x1, y1 = self.x, self.y
         x2, y2 = self.dest
 
         i, j = x2 - x1, y2 - y1
@@ -554,7 +1036,8 @@ class Person(pygame.sprite.Sprite):
 
         try:
             # Vector on which person should move to the destination
-            self.vector = (i*self.movement)/magnitude, (j*self.movement)/magnitude
+            self.vx = (i*self.movement)/magnitude
+            self.vy = (j*self.movement)/magnitude
         # Occurs when magnitude is so small float rounds to zero
         # This means person already next to the destination, so do not create route
         except ZeroDivisionError:
@@ -576,13 +1059,17 @@ class Person(pygame.sprite.Sprite):
                 self.despawn_time -= 1
                 return False
 
-        x,y = self.coords
+        # Quarantined people do not move
+        if self.quarantined == True:
+            return False
+
+        x, y = self.x, self.y
 
         if self.dest == None:
 
             # New coordinates
-            nx = eval(f'{x}{random.choice(["+", "-"])}{self.movement}')
-            ny = eval(f'{y}{random.choice(["+", "-"])}{self.movement}')
+            nx = x + random.choice((-self.movement, self.movement))
+            ny = y + random.choice((-self.movement, self.movement))
             # Boundaries of community
             mx, my = self.community_size
             # Valid coordinates are the boundaries accounted for size of person
@@ -609,46 +1096,42 @@ class Person(pygame.sprite.Sprite):
 
             if abs(dx - x) < 10 and abs(dy - y) < 10:
 
-                # If home doesnt exist and person at destination
-                # then person has returned home
-                try:
-                    if self.stay_time == 0:
+                if self.stay_time == 0:
 
+                    # If home doesnt exist and person at destination
+                    # then person has returned home
+                    if self.home == None:
+                        self.dest = None
                         self.stay_time = 100
-                        self.route(self.home, False)
-
-                        del self.home
-
                     else:
-                        self.stay_time -= 1
+                        self.return_home()
 
-                except AttributeError:
-                    self.dest = None
-                    self.stay_time == 100
+                else:
+                    self.enter()
+                    self.stay_time -= 1
 
                 nx, ny = dx, dy
 
             # Add vector to coords
             else:
-                x, y = self.coords
-                i, j = self.vector
-                nx = x + i
-                ny = y + j
+                nx = x + self.vx
+                ny = y + self.vy
 
-        # Update position of rect on surface
-        self.rect.x = round(nx)
-        self.rect.y = round(ny)
-        self.coords = nx, ny
+        self.x = nx
+        self.y = ny
 
         return False
 
 
 class Place(pygame.sprite.Sprite):
 
-    def __init__(self, community_size):
+    def __init__(self, community_size, index):
 
         pygame.sprite.Sprite.__init__(self)
 
+        # Position of the place in its community
+        self.index = index
+
         self.size = (15, 15)
         self.image = pygame.Surface(self.size)
         self.image.fill(config.theme.place)
@@ -658,29 +1141,212 @@ class Place(pygame.sprite.Sprite):
         self.rect.y = random.randint(1,community_size[1] - self.size[1])
         self.coords = (self.rect.x + self.size[0]/2, self.rect.y + self.size[1]/2)
 
+        # People currently inside the place, a dict is used as an insertion ordered set
+        self.occupants = {}
+        self.open = True
+
 
 class Community:
     '''
     Is a pygame frame that sits encapsulated within simulation
     '''
 
-    def __init__(self, coords, surf_size, population, places) -> None:
+    def __init__(self, coords, surf_size, population, places, index) -> None:
 
         global stats, pathogen
 
+        # Position of the community in the layout, read row by row
+        self.index = index
         self.coords = coords
         self.surf_size = surf_size
         self.surf = pygame.Surface(self.surf_size)
 
         # Create list of people in the community
-        self.population = pygame.sprite.Group()
-        for _ in range(population):
-            self.population.add(Person(self.surf_size))
+        self.population = [Person(self.surf_size, index) for _ in range(population)]
 
         # Create places in community
         self.places = pygame.sprite.Group()
-        for _ in range(places):
-            self.places.add(Place(self.surf_size))
+        for index in range(places):
+            self.places.add(Place(self.surf_size, index))
+
+        # Chance per cycle an infected person is detected and quarantined, the
+        # one of the latest quarantine in force out of those started on the community
+        self.detection = 0
+        self.detections = []
+        # Number of interventions keeping the places closed
+        self.closures = 0
+        # Susceptible people outside places during the last update
+        self.susceptible = []
+
+        # Communities without infected people are dormant, nobody moves and
+        # only migration is stepped, every config.sim.quiet_stride cycles
+        self.dormant = False
+        self.idle = 0
+        # Population changed while dormant and the surface needs redrawing
+        self.stale = False
+
+        # Drawn person by person this cycle, otherwise shown as a heat tile or not at all
+        self.detailed = True
+        # Infected people during the last update
+        self.cases = 0
+        # Drawn as density maps by draw_heatmap(), which leaves out routes
+        self.heatmap = False
+        # Columns and rows of heatmap cells, and the people in each state and
+        # cell while drawn as a heatmap, None otherwise
+        cell = config.app.heatmap_cell
+        self.grid = (-(-self.surf_size[0] // cell), -(-self.surf_size[1] // cell))
+        self.density = None
+
+    def close_places(self) -> None:
+        '''
+        Closes every place in the community and sends occupants home.
+        '''
+        self.closures += 1
+        for place in self.places:
+            place.open = False
+            for person in list(place.occupants):
+                person.return_home()
+
+    def open_places(self) -> None:
+        '''
+        Lifts one closure of the places, they reopen once no intervention
+        keeps them closed any more.
+        '''
+        self.closures = max(self.closures - 1, 0)
+        if self.closures > 0:
+            return
+
+        for place in self.places:
+            place.open = True
+
+    def quarantine(self, detection: float) -> None:
+        '''
+        Starts a quarantine detecting infected people with the given chance per cycle.
+        '''
+        self.detections.append(detection)
+        self.detection = detection
+
+    def release(self, detection: float) -> None:
+        '''
+        Ends a quarantine started with quarantine(), the detection goes back
+        to that of the quarantines still in force, or 0 without any.
+        '''
+        if detection in self.detections:
+            self.detections.remove(detection)
+        self.detection = self.detections[-1] if len(self.detections) > 0 else 0
+
+    def sleep(self) -> None:
+        '''
+        Collapses the community once it has no infected people. The dead are
+        despawned straight away and everyone else stops where they are.
+        '''
+        self.dormant = True
+        self.idle = 0
+
+        for person in self.population:
+            if person.dead == True:
+                self.unbin(person)
+
+        self.population = [person for person in self.population if person.dead == False]
+        for person in self.population:
+            person.leave()
+            person.dest = None
+            person.home = None
+            person.stay_time = 100
+
+    def wake(self) -> None:
+        '''
+        Brings a dormant community back to per person updates, scattering
+        its people to random locations as their positions were not kept.
+        '''
+        self.dormant = False
+        for person in self.population:
+            person.set_random_location()
+            self.bin(person)
+
+    def count_cells(self, enabled: bool) -> None:
+        '''
+        Starts or stops keeping count of the people in each heatmap cell.
+        Starting counts everyone once, afterwards people are moved between
+        cells as they move or change state, see bin().
+        '''
+        if enabled == False:
+            self.density = None
+            return
+
+        width, height = self.grid
+        self.density = [0] * (4 * width * height)
+        for person in self.population:
+            person.cell = -1
+            self.bin(person)
+
+    def bin(self, person) -> None:
+        '''
+        Counts a person in the heatmap cell of their position and state,
+        taking them out of the one they were counted in before.
+        '''
+        if self.density == None:
+            return
+
+        width, height = self.grid
+        cell = config.app.heatmap_cell
+        column = min(max(int((person.x + Person.size[0]/2) // cell), 0), width - 1)
+        row = min(max(int((person.y + Person.size[1]/2) // cell), 0), height - 1)
+        # State codes as in kernels
+        state = 3 if person.dead else 1 if person.infected else 2 if person.immune else 0
+
+        key = (state * width + column) * height + row
+        if key != person.cell:
+            if person.cell >= 0:
+                self.density[person.cell] -= 1
+            self.density[key] += 1
+            person.cell = key
+
+    def unbin(self, person) -> None:
+        '''
+        Stops counting a person who left the community.
+        '''
+        if self.density != None and person.cell >= 0:
+            self.density[person.cell] -= 1
+        person.cell = -1
+
+    def heat(self) -> tuple:
+        '''
+        Returns the colour the community is drawn in as a single tile, shading
+        from the background to the infected colour with the share infected.
+        '''
+        share = math.sqrt(self.cases / max(len(self.population), 1))
+        return tuple(round(bg + (fg - bg) * share) for bg, fg in zip(config.theme.simbg, config.theme.infected))
+
+    def draw_heatmap(self) -> None:
+        '''
+        Draws the community as a low resolution map of where people are,
+        coloured by the states of the people in each cell and shaded by how
+        crowded it is. The people in each cell are kept count of as they move,
+        see bin(), so drawing costs the same however many people there are.
+        '''
+        width, height = self.grid
+        counts = np.array(self.density, dtype=np.float64).reshape(4, width, height)
+
+        # Colours in the order of the state codes in kernels
+        colours = np.array([config.theme.susceptible, config.theme.infected,
+                config.theme.immune, config.theme.dead], dtype=np.float64)
+        background = np.array(config.theme.simbg, dtype=np.float64)
+
+        total = counts.sum(axis=0)
+        mix = np.einsum("swh,sc->whc", counts, colours) / np.maximum(total, 1)[:, :, None]
+        shade = np.sqrt(total / max(total.max(), 1))[:, :, None]
+
+        pixels = (background + (mix - background) * shade).astype(np.uint8)
+        pygame.transform.scale(pygame.surfarray.make_surface(pixels), self.surf_size, self.surf)
+
+    def draw_population(self) -> None:
+        '''
+        Draws every person onto the community surface in their state colour.
+        '''
+        width, height = Person.size
+        for person in self.population:
+            self.surf.fill(person.colour(), (round(person.x), round(person.y), width, height))
 
     def update(self) -> list:
         '''
@@ -691,21 +1357,47 @@ class Community:
             A list of people objects to be migrated to another community
         '''
 
-        population_list = self.population.sprites()
+        # Heatmap cells are only kept count of while drawn as a heatmap, and
+        # are counted afresh when switched to it
+        if self.heatmap != (self.density != None):
+            self.count_cells(self.heatmap)
+        counting = self.density != None
+
+        if self.dormant == True:
+            self.idle += 1
+            if self.idle % config.sim.quiet_stride != 0:
+                return []
+            # Catch up on the migrations of the skipped cycles
+            return self.__calc_migration_events(config.sim.quiet_stride)
+
+        population_list = self.population
+        # People still in the community after the dead have despawned
+        remaining = []
         susceptible = []
         infected = []
         dead = []
         immune = []
+        # Infected people inside places or quarantine, they only meet other occupants
+        sheltered = []
 
         for person in population_list:
 
             despawn = person.update()
 
-            if person.dead == True:
+            if despawn == False:
+                remaining.append(person)
+                # States changed later in the cycle are counted from the next one
+                if counting:
+                    self.bin(person)
+            elif counting:
+                self.unbin(person)
 
+            if person.dead == True:
                 dead.append(person)
-                if despawn == True:
-                    self.population.remove(person)
+
+            elif person.place != None or person.quarantined == True:
+                if person.infected == True:
+                    sheltered.append(person)
 
             elif person.infected == True:
                 infected.append(person)
@@ -716,70 +1408,139 @@ class Community:
             else:
                 susceptible.append(person)
 
-            if person.dest != None:
-                pygame.draw.line(self.surf, config.theme.route, person.coords, person.dest)
+            if person.dest != None and self.detailed == True and self.heatmap == False:
+                pygame.draw.line(self.surf, config.theme.route, (person.x, person.y), person.dest)
+
+        self.population = remaining
 
         # zombie refering to infected person
         for zombie in infected:
            for person in susceptible:
-                pathogen.infect(person, zombie)
+                pathogen.infect(person, zombie, self.index)
 
            pathogen.update_health(zombie)
 
+           # Detected cases are quarantined from the next cycle
+           if self.detection > 0 and random.random() < self.detection:
+               zombie.isolate()
+
+        # Occupants of each place only come into contact with each other
+        for place in self.places:
+            pathogen.infect_place(place, self.index)
+
+        for zombie in sheltered:
+            pathogen.update_health(zombie)
+
+            if self.detection > 0 and random.random() < self.detection:
+                zombie.isolate()
+
+        self.susceptible = susceptible
+        self.cases = len(infected) + len(sheltered)
+
         self.__calc_movement_events()
-        return self.__calc_migration_events()
+        migrants = self.__calc_migration_events()
+
+        # Nobody could have been infected this cycle, nothing happens until an infected migrant arrives
+        if len(infected) == 0 and len(sheltered) == 0:
+            self.sleep()
+
+        return migrants
 
 
     def __calc_movement_events(self):
         '''
         Manages whether a person heads to a place in a community
         '''
-        if len(self.places) == 0:
+        places = [place for place in self.places if place.open]
+        if len(places) == 0:
             return
 
         move_chance = config.sim.movement
 
         def check(person):
-            if person.dead == False and person.dest == None:
+            if person.dead == False and person.dest == None and person.quarantined == False:
                 return True
 
-        valid = list(filter(check, self.population.sprites()))
+        valid = list(filter(check, self.population))
 
         while (random.random() < move_chance) and len(valid) > 0:
             mover = random.choice(valid)
-            mover.route(random.choice(self.places.sprites()).coords, True)
+            mover.visit(random.choice(places))
             valid.remove(mover)
 
 
-    def __calc_migration_events(self):
+    def __calc_migration_events(self, cycles=1):
         '''
         Manages whether migrations occur.
+
+        Arguments:
+            cycles: number of cycles of migration events to draw at once
         '''
 
         mig_chance = config.sim.migration
 
         def check(person):
-            if person.dead == False and person.dest == None:
+            if person.dead == False and person.dest == None and person.quarantined == False:
                 return True
 
-        valid = list(filter(check, self.population.sprites()))
+        valid = list(filter(check, self.population))
 
         migrants = []
-        while (random.random() < mig_chance) and len(valid) > 0:
-            migrant = random.choice(valid)
-            migrants.append(migrant)
+        for _ in range(cycles):
+            while (random.random() < mig_chance) and len(valid) > 0:
+                migrant = random.choice(valid)
+                migrants.append(migrant)
+                valid.remove(migrant)
 
         return migrants
 
-def main():
+def create_communities() -> list:
+    '''
+    Initialises communities according to config file.
+
+    Returns:
+        list of community objects.
+    '''
+    communities = []
+
+    # Create each community in grid defined by layout
+    compiled = scenario.current()
+
+    for (coords, size), pop, places in zip(compiled.cells, compiled.populations, compiled.places):
+        communities.append(Community(coords, size, pop, places, len(communities)))
+
+    return communities
+
 
-    global pathogen, stats
+def reset() -> None:
+    '''
+    Starts the pathogen, counters and transmission log of a new run from
+    the loaded configuration.
+    '''
+
+    global pathogen, stats, tracer
 
     pathogen = Pathogen()
     stats = Stats()
+    # The defaults of Stats are read from the configuration main was imported with
+    stats.infected, stats.susceptible = config.sim.infected, config.sim.susceptible
+    stats.dead, stats.immune = config.sim.dead, config.sim.immune
+    tracer = tracing.Tracer(config.tracing)
+
+
+def main():
+
+    reset()
+
+    # Offscreen recordings draw to memory, the video driver must be swapped before the window is made
+    offscreen = config.record.get("enabled", False) and config.record.get("offscreen", False)
+    if offscreen:
+        pygame.display.quit()
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        pygame.display.init()
 
-    simulation = Simulation()
-    simulation.run()
+    simulation = Simulation(offscreen)
+    simulation.run(config.record.get("ticks", 0) if offscreen else 0)
 
 
 def call_stack_statistics():
@@ -0,0 +1,71 @@
+# Reports how much memory the agents of a configuration take up, to size
+# machines for large runs without opening the simulation window.
+#
+# Usage: python memory.py [config.json] [population]
+#
+# If a population is given the layout is scaled to hold that many people.
+import os, sys, tracemalloc, resource
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import config
+
+
+def rss() -> int:
+    '''
+    Returns the current resident set size of the process in bytes.
+    '''
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    # Not linux, fall back to the peak which getrusage reports in KB
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def scale_layout(layout: list, population: int) -> list:
+    '''
+    Resizes every community so the layout holds the given population.
+    '''
+    communities = sum(len(cols) for cols in layout)
+    size, remainder = divmod(population, communities)
+
+    scaled = [[[size, places] for _, places in cols] for cols in layout]
+    scaled[0][0][0] += remainder
+    return scaled
+
+
+def report(config_addr: str, population=None) -> None:
+    '''
+    Builds every community of a configuration and prints the memory used.
+
+    Arguments:
+        config_addr: path of the config file
+        population: optional number of people to scale the layout to
+    '''
+    config.load(config_addr, show_menu=False)
+    if population is not None:
+        config.sim.layout = scale_layout(config.sim.layout, population)
+
+    import main
+
+    baseline = rss()
+    tracemalloc.start()
+    communities = main.create_communities()
+    allocated, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    agents = sum(len(community.population) for community in communities)
+    mb = 1024 * 1024
+
+    print(f'Agents: {agents} in {len(communities)} communities')
+    print(f'Bytes per agent: {allocated / max(agents, 1):.1f}')
+    print(f'Agent memory: {allocated / mb:.1f} MB (peak {peak / mb:.1f} MB while building)')
+    print(f'RSS: {rss() / mb:.1f} MB ({baseline / mb:.1f} MB before building)')
+
+
+if __name__ == "__main__":
+
+    config_addr = sys.argv[1] if len(sys.argv) > 1 else "config.json"
+    population = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    report(config_addr, population)
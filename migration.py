@@ -0,0 +1,169 @@
+# Migration network between communities.
+#
+# config.sim.topology picks which communities migrants can travel to:
+#   "all"     - any other community, equally likely
+#   "grid"    - the communities next to it in config.sim.layout
+#   "gravity" - any other community, weighted by its population over the
+#               squared distance between them in the layout
+#   [[...]]   - an explicit matrix of weights, row i holding the weights of
+#               migrating from community i to every community
+import random
+
+
+class AliasTable:
+    '''
+    Purpose: Samples an index from a discrete distribution in constant time
+    using Vose's alias method.
+
+    Args:
+        weights: list of non-negative weights, at least one positive
+    '''
+
+    def __init__(self, weights: list) -> None:
+
+        self.size = len(weights)
+        self.prob = [1.0] * self.size
+        self.alias = list(range(self.size))
+
+        total = sum(weights)
+        scaled = [weight * self.size / total for weight in weights]
+
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+
+        # Pair every under-full column with an over-full one
+        while small and large:
+            less, more = small.pop(), large.pop()
+
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+
+            scaled[more] += scaled[less] - 1
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+
+    def sample(self, rng=random) -> int:
+        '''
+        Returns a random index with probability proportional to its weight.
+
+        Arguments:
+            rng: source of uniform draws, the random module or a numpy Generator
+        '''
+        column = int(rng.random() * self.size)
+        if rng.random() < self.prob[column]:
+            return column
+        return self.alias[column]
+
+
+def weights(layout: list, topology) -> list:
+    '''
+    Builds the matrix of migration weights between communities.
+
+    Arguments:
+        layout: config.sim.layout
+        topology: config.sim.topology
+
+    Returns:
+        list of rows, row i holding the weights from community i
+    '''
+
+    # Grid position and population of each community, read row by row
+    cells = [(y, x, pop) for y, cols in enumerate(layout) for x, (pop, _) in enumerate(cols)]
+    count = len(cells)
+
+    if isinstance(topology, list):
+        if len(topology) != count or any(len(row) != count for row in topology):
+            raise ValueError(f'Migration topology must be a {count}x{count} matrix')
+        return [[float(w) if i != j else 0.0 for j, w in enumerate(row)] for i, row in enumerate(topology)]
+
+    matrix = [[0.0] * count for _ in range(count)]
+
+    for i, (y1, x1, _) in enumerate(cells):
+        for j, (y2, x2, pop) in enumerate(cells):
+
+            if i == j:
+                continue
+
+            if topology == "all":
+                matrix[i][j] = 1.0
+            elif topology == "grid":
+                matrix[i][j] = 1.0 if abs(y1 - y2) + abs(x1 - x2) == 1 else 0.0
+            elif topology == "gravity":
+                matrix[i][j] = pop / ((y1 - y2)**2 + (x1 - x2)**2)
+            else:
+                raise ValueError(f'Unknown migration topology: {topology}')
+
+    return matrix
+
+
+class Network:
+    '''
+    Purpose: Picks destinations for migrants, with an alias table per
+    community so each pick is constant time.
+
+    Args:
+        layout: config.sim.layout
+        topology: config.sim.topology
+    '''
+
+    def __init__(self, layout: list, topology) -> None:
+
+        self.matrix = weights(layout, topology)
+        # Communities cut off from migration, with how many interventions
+        # block each, so overlapping interventions lift only their own blocks
+        self.blocked = {}
+        self.__build()
+
+    def __build(self) -> None:
+        '''
+        Builds an alias table over the reachable destinations of every community.
+        '''
+        self.tables = []
+
+        for i, row in enumerate(self.matrix):
+
+            targets = [j for j, w in enumerate(row)
+                    if w > 0 and i not in self.blocked and j not in self.blocked]
+
+            if len(targets) == 0:
+                self.tables.append(None)
+            else:
+                self.tables.append((targets, AliasTable([row[j] for j in targets])))
+
+    def block(self, indices: list) -> None:
+        '''
+        Stops migration into and out of the given communities.
+        '''
+        for index in indices:
+            self.blocked[index] = self.blocked.get(index, 0) + 1
+        self.__build()
+
+    def unblock(self, indices: list) -> None:
+        '''
+        Lifts one block on each of the given communities, migration resumes
+        once no intervention blocks a community any more.
+        '''
+        for index in indices:
+            if self.blocked.get(index, 0) > 1:
+                self.blocked[index] -= 1
+            else:
+                self.blocked.pop(index, None)
+        self.__build()
+
+    def destination(self, index: int, rng=random):
+        '''
+        Returns the index of the community a migrant from community index
+        moves to, or None when it has nowhere to go.
+
+        Arguments:
+            index: community the migrant is leaving
+            rng: source of uniform draws, the random module or a numpy Generator
+        '''
+        table = self.tables[index]
+        if table is None:
+            return None
+
+        targets, alias = table
+        return targets[alias.sample(rng)]
@@ -0,0 +1,146 @@
+# Records the window of a simulation to a PNG sequence or an animated GIF.
+#
+# Enabled with "record" in config.json, for example:
+#
+#   "record": {"enabled": true, "path": "frames", "format": "png", "stride": 10}
+#
+# Every stride cycles the window is copied out as raw bytes and handed
+# through a bounded queue to an encoder thread, which writes
+# {path}/{tick}.png or, once the run ends, a single {path}.gif. When the
+# encoder falls behind, the simulation waits for room in the queue rather
+# than holding frames without limit, so a stride that keeps the encoder busy
+# less than the simulation costs nothing.
+#
+# A GIF is written in one go at the end, so its frames are held in memory
+# until then. Once more than "frames" are held, every other one is dropped
+# and the stride doubled, so a long run still gives an animation of the
+# whole run in bounded memory. PNG frames are written as they come.
+#
+# With "offscreen": true the simulation draws through the SDL dummy video
+# driver without a window, does not wait between cycles, only draws the
+# cycles it records and ends after "ticks" cycles, or runs until stopped
+# with 0, so long runs can be turned into short animations on machines
+# without a display. GIF needs Pillow, PNG only pygame.
+import os, queue, threading
+import pygame
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+FORMATS = ("png", "gif")
+
+
+class Recorder:
+    '''
+    Purpose: Encodes frames of the window on a background thread.
+
+    Args:
+        settings: dict read from config.json, see the top of this module
+        size: (width, height) of the frames
+    '''
+
+    def __init__(self, settings: dict, size: tuple) -> None:
+
+        self.path = settings.get("path", "frames")
+        self.format = settings.get("format", "png")
+        self.stride = max(settings.get("stride", 1), 1)
+        # Milliseconds each GIF frame is shown for
+        self.duration = settings.get("duration", 40)
+        # GIF frames held before the recording is thinned
+        self.limit = max(settings.get("frames", 500), 2)
+        self.size = tuple(size)
+
+        if self.format not in FORMATS:
+            raise ValueError(f'Record format must be one of {", ".join(FORMATS)}, got {self.format!r}')
+        if self.format == "gif" and Image is None:
+            raise ImportError("Pillow is needed to record GIF")
+
+        # Frames waiting to be encoded, as (tick, bytes), None ends the recording
+        self.frames = queue.Queue(maxsize=settings.get("queue", 32))
+        self.thread = None
+        self.written = 0
+        # Error the encoder stopped on, raised in the simulation thread
+        self.error = None
+
+    def start(self) -> None:
+        '''
+        Starts the encoder thread.
+        '''
+        if self.format == "png":
+            os.makedirs(self.path, exist_ok=True)
+
+        # A simulation that fails before close() must still be able to exit
+        self.thread = threading.Thread(target=self.__encode, daemon=True)
+        self.thread.start()
+
+    def due(self, tick: int) -> bool:
+        '''
+        Returns whether the cycle is one to record.
+        '''
+        return tick % self.stride == 0
+
+    def capture(self, surface: pygame.Surface, tick: int) -> None:
+        '''
+        Hands a copy of the surface to the encoder if the cycle is one to record.
+        '''
+        if self.error is not None:
+            raise self.error
+        if self.due(tick) == False:
+            return
+
+        self.frames.put((tick, pygame.image.tobytes(surface, "RGB")))
+
+    def close(self) -> None:
+        '''
+        Waits for every frame to be encoded and writes the GIF.
+        '''
+        self.frames.put(None)
+        self.thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def __encode(self) -> None:
+        '''
+        Encodes frames until the recording ends. After an error the frames
+        are still taken off the queue, so the simulation never waits on it.
+        '''
+        images = []
+        ticks = []
+
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                continue
+            tick, data = frame
+
+            try:
+                if self.format == "png":
+                    image = pygame.image.frombytes(data, self.size, "RGB")
+                    pygame.image.save(image, os.path.join(self.path, f'{tick:08d}.png'))
+                    self.written += 1
+                elif tick % self.stride == 0:
+                    # Palette images take a third of the memory until the GIF is written
+                    images.append(Image.frombytes("RGB", self.size, data).quantize())
+                    ticks.append(tick)
+
+                    if len(images) > self.limit:
+                        self.stride *= 2
+                        kept = [index for index, at in enumerate(ticks) if at % self.stride == 0]
+                        images = [images[index] for index in kept]
+                        ticks = [ticks[index] for index in kept]
+                    self.written = len(images)
+            except Exception as error:
+                self.error = error
+
+        if self.error is None and len(images) > 0:
+            try:
+                images[0].save(f'{self.path}.gif', save_all=True, append_images=images[1:],
+                        duration=self.duration, loop=0)
+            except Exception as error:
+                self.error = error
@@ -0,0 +1,326 @@
+# Checks that changes to the simulation code leave the epidemic dynamics as
+# they were, and times the simulation across sizes and backends.
+#
+# Small seeded scenarios are run headlessly and compared against golden
+# results saved in golden/{scenario}.npz:
+#
+#   exact     both engines are deterministic for a seed, so the counts of a
+#             seeded run at every cycle must match the golden trajectory
+#             exactly, on the array engine with every kernel backend
+#             available and on the object engine behind the window, a
+#             backend that is not installed is reported as SKIP
+#   ensemble  the epidemic metrics of an ensemble of engine replicates and of
+#             runs of the object engine under different seeds must come from
+#             the same distribution as the golden ensemble, checked with a
+#             two-sample Kolmogorov-Smirnov test of each metric
+#
+# Rewrites that keep the dynamics but draw random numbers in another order
+# fail the exact check and pass the ensemble check, which is the one that
+# matters for them. Golden results are only written by "update", after a
+# change in the dynamics was meant.
+#
+# Usage:
+#   python regression.py [check] [scenario ...]
+#   python regression.py update [scenario ...]
+#   python regression.py bench [population ...]
+import copy, json, os, random, sys, time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import numpy as np
+
+import config, kernels
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GOLDEN = os.path.join(HERE, "golden")
+
+# Cycles every scenario is run for and runs in each ensemble, engine
+# replicates are batched so they are cheap enough to make the test sharper
+TICKS = 300
+REPLICATES = 96
+WINDOW_RUNS = 24
+# Chance of a metric failing the ensemble check when nothing changed
+ALPHA = 0.001
+
+# Metrics compared by the ensemble check
+METRICS = ("susceptible", "infected", "immune", "dead", "peak", "peak_tick", "attack_rate")
+
+# Settings of each scenario, every setting that shapes a run is given so
+# golden results do not depend on config.json
+SCENARIOS = {
+    "single": {
+        "simulation": {"layout": [[[300, 2]]], "movements": 0.2, "migrations": 0, "population": 300,
+                "dead": 0, "immune": 0, "susceptible": 300, "infected": 0, "topology": "all", "quiet_stride": 10},
+        "pathogen": {"catchment": 5, "curability": 0.005, "infectiousness": 0.1, "lethality": 0.001,
+                "immunity": 0, "place_infectiousness": 0.005}},
+    "grid": {
+        "simulation": {"layout": [[[150, 2], [150, 1]], [[150, 0], [150, 3]]], "movements": 0.3,
+                "migrations": 0.05, "population": 600, "dead": 0, "immune": 0, "susceptible": 600,
+                "infected": 0, "topology": "all", "quiet_stride": 10},
+        "pathogen": {"catchment": 5, "curability": 0.005, "infectiousness": 0.1, "lethality": 0.001,
+                "immunity": 200, "place_infectiousness": 0.005}},
+}
+
+# Settings of every scenario outside the simulation and pathogen
+COMMON = {
+    "app": {"sim_size": [360, 360], "min_community": 30, "render": "agents"},
+    "interventions": [],
+    "tracing": {"enabled": False},
+    "ensemble": {"replicates": 0},
+    "control": {"enabled": False},
+    "scenario": {"cache": None, "cases": None},
+    "stop": {"extinct": False},
+    "record": {"enabled": False},
+}
+
+
+def apply(name: str, population=None) -> None:
+    '''
+    Loads config.json with the settings of a scenario over it.
+
+    Arguments:
+        name: key of SCENARIOS
+        population: number of people to scale the layout to, None to keep it
+    '''
+    with open(os.path.join(HERE, "config.json"), "r") as config_file:
+        settings = json.loads(config_file.read())
+
+    for section, values in dict(COMMON, **SCENARIOS[name]).items():
+        if isinstance(values, dict) and isinstance(settings.get(section), dict):
+            settings[section] = dict(settings[section], **copy.deepcopy(values))
+        else:
+            settings[section] = copy.deepcopy(values)
+
+    if population is not None:
+        import memory
+        simulation = settings["simulation"]
+        simulation["layout"] = memory.scale_layout(simulation["layout"], population)
+        simulation["population"] = simulation["susceptible"] = population
+
+    config.apply(settings)
+
+
+def run_engine(seed: int, replicates: int, ticks=TICKS) -> tuple:
+    '''
+    Runs the loaded scenario on the array engine.
+
+    Returns:
+        (history, metrics), the (cycles + 1, replicates, 4) counts and a
+        dict of each metric in METRICS with one value per replicate
+    '''
+    import engine
+
+    simulation = engine.Engine(seed, replicates)
+    history = simulation.run(ticks, config.stop)
+    snapshot = simulation.analytics.snapshot()
+
+    metrics = dict(zip(METRICS[:4], history[-1].T))
+    metrics.update({name: snapshot[name] for name in METRICS[4:]})
+    return history, metrics
+
+
+def run_window(seed: int, ticks=TICKS) -> tuple:
+    '''
+    Runs the loaded scenario on the object engine behind the window, drawn
+    offscreen, see recorder.py.
+
+    Returns:
+        (history, metrics), the (cycles + 1, 4) counts from the start, in
+        the order of METRICS, and a dict of each metric in METRICS
+    '''
+    import main
+
+    random.seed(seed)
+    main.reset()
+
+    simulation = main.Simulation(offscreen=True)
+    simulation.run(ticks)
+
+    # The graph takes the counters of every cycle
+    values = simulation.graph.values
+    history = np.array([values[tuple(getattr(config.theme, name))] for name in METRICS[:4]], dtype=np.int64).T
+
+    stats = main.stats
+    snapshot = simulation.analytics.snapshot()
+    metrics = {"susceptible": stats.susceptible, "infected": stats.infected, "immune": stats.immune, "dead": stats.dead}
+    metrics.update({name: float(snapshot[name]) for name in METRICS[4:]})
+    return history, metrics
+
+
+def ensembles() -> dict:
+    '''
+    Runs the ensembles of the loaded scenario.
+
+    Returns:
+        dict of {"engine": metrics, "window": metrics}, each metric an
+        array with one value per run
+    '''
+    _, engine_metrics = run_engine(0, REPLICATES)
+
+    runs = [run_window(seed)[1] for seed in range(WINDOW_RUNS)]
+    window_metrics = {name: np.array([run[name] for run in runs], dtype=np.float64) for name in METRICS}
+
+    return {"engine": engine_metrics, "window": window_metrics}
+
+
+def ks_test(a: np.ndarray, b: np.ndarray) -> tuple:
+    '''
+    Two-sample Kolmogorov-Smirnov test of whether two samples come from the
+    same distribution. nan values, such as metrics never reached, are
+    compared as their own value.
+
+    Returns:
+        (statistic, p), p from the asymptotic distribution of the statistic
+    '''
+    a = np.where(np.isnan(a), np.inf, np.asarray(a, dtype=np.float64))
+    b = np.where(np.isnan(b), np.inf, np.asarray(b, dtype=np.float64))
+
+    values = np.concatenate([a, b])
+    cdf_a = np.searchsorted(np.sort(a), values, side="right") / a.shape[0]
+    cdf_b = np.searchsorted(np.sort(b), values, side="right") / b.shape[0]
+    statistic = np.abs(cdf_a - cdf_b).max()
+
+    # Kolmogorov distribution with the small sample correction of Stephens
+    n = np.sqrt(a.shape[0] * b.shape[0] / (a.shape[0] + b.shape[0]))
+    scaled = (n + 0.12 + 0.11 / n) * statistic
+    if scaled < 1e-3:
+        return statistic, 1.0
+
+    terms = np.arange(1, 101)
+    p = 2 * np.sum((-1.0) ** (terms - 1) * np.exp(-2 * terms ** 2 * scaled ** 2))
+    return statistic, float(min(max(p, 0.0), 1.0))
+
+
+def update(name: str) -> None:
+    '''
+    Runs a scenario and saves its results as the golden ones.
+    '''
+    apply(name)
+    history, _ = run_engine(0, 1)
+    window_history, _ = run_window(0)
+    results = ensembles()
+
+    arrays = {"history": history, "window_history": window_history}
+    for kind, metrics in results.items():
+        arrays.update({f'{kind}_{metric}': np.asarray(values) for metric, values in metrics.items()})
+
+    os.makedirs(GOLDEN, exist_ok=True)
+    np.savez_compressed(os.path.join(GOLDEN, f'{name}.npz'), **arrays)
+
+
+def compare(label: str, history: np.ndarray, golden: np.ndarray) -> bool:
+    '''
+    Compares the counts of a run with the golden ones cycle by cycle,
+    printing the result.
+
+    Returns:
+        whether they are equal
+    '''
+    if history.shape != golden.shape:
+        print(f'FAIL {label}: counts of shape {history.shape}, golden {golden.shape}')
+        return False
+
+    differs = np.flatnonzero((history != golden).reshape(history.shape[0], -1).any(axis=1))
+    if differs.shape[0] > 0:
+        print(f'FAIL {label}: first differs at cycle {differs[0]}')
+        return False
+
+    print(f'PASS {label}')
+    return True
+
+
+def check(name: str) -> bool:
+    '''
+    Runs a scenario and compares it with its golden results, printing every
+    comparison.
+
+    Returns:
+        whether every comparison passed
+    '''
+    path = os.path.join(GOLDEN, f'{name}.npz')
+    if not os.path.exists(path):
+        print(f'FAIL {name}: no golden results, run "python regression.py update {name}"')
+        return False
+
+    with np.load(path) as saved:
+        golden = {key: saved[key] for key in saved.files}
+
+    apply(name)
+    passed = True
+
+    # Every backend is held to the golden trajectory, numba is only
+    # reported as skipped where it is not installed rather than left out
+    for backend in kernels.BACKENDS:
+        if backend == "numba" and kernels.numba is None:
+            print(f'SKIP {name} exact numba: numba is not installed')
+            continue
+        kernels.use(backend)
+        history, _ = run_engine(0, 1)
+        passed &= compare(f'{name} exact {backend}', history, golden["history"])
+    kernels.use("numba" if kernels.numba is not None else "numpy")
+
+    history, _ = run_window(0)
+    passed &= compare(f'{name} exact window', history, golden["window_history"])
+
+    for kind, metrics in ensembles().items():
+        for metric in METRICS:
+            statistic, p = ks_test(np.asarray(metrics[metric]), golden[f'{kind}_{metric}'])
+            result = "PASS" if p >= ALPHA else "FAIL"
+            print(f'{result} {name} ensemble {kind} {metric}: D={statistic:.3f} p={p:.3g}')
+            passed &= p >= ALPHA
+
+    return passed
+
+
+def bench(populations: list) -> None:
+    '''
+    Times every scenario at each population on every kernel backend and on
+    the object engine, printing cycles per second.
+    '''
+    ticks = 100
+    backends = ["numpy"] + (["numba"] if kernels.numba is not None else [])
+
+    print(f'{"scenario":<10}{"population":>12}' + "".join(f'{name:>12}' for name in backends + ["window"]))
+    for name in SCENARIOS:
+        for population in populations:
+            apply(name, population)
+            rates = []
+
+            for backend in backends:
+                kernels.use(backend)
+                # The first run of a numba kernel compiles it
+                run_engine(0, 1, 1)
+                started = time.perf_counter()
+                run_engine(0, 1, ticks)
+                rates.append(ticks / (time.perf_counter() - started))
+            kernels.use(backends[-1])
+
+            started = time.perf_counter()
+            run_window(0, ticks)
+            rates.append(ticks / (time.perf_counter() - started))
+
+            print(f'{name:<10}{population:>12}' + "".join(f'{rate:>12.1f}' for rate in rates))
+
+
+if __name__ == "__main__":
+
+    command = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] in ("check", "update", "bench") else "check"
+    arguments = sys.argv[2:] if len(sys.argv) > 1 and sys.argv[1] == command else sys.argv[1:]
+
+    if command == "bench":
+        bench([int(arg) for arg in arguments] or [1000, 10000])
+        sys.exit()
+
+    names = arguments or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if len(unknown) > 0:
+        sys.exit(f'Unknown scenarios: {", ".join(unknown)}')
+
+    if command == "update":
+        for name in names:
+            update(name)
+            print(f'Golden results of {name} written to {GOLDEN}')
+    else:
+        results = [check(name) for name in names]
+        sys.exit(0 if all(results) else 1)
@@ -0,0 +1,289 @@
+# Compiles the loaded configuration into the fixed data every run of it
+# starts from.
+#
+# The layout geometry is worked out once per configuration, and the random
+# initial positions of people and places are cached on disk under
+# "scenario": {"cache": ...} in config.json, keyed by a hash of the settings
+# that shape them and the seed. Later runs of the same configuration and
+# seed, such as the workers of a sweep, memory-map the cached arrays instead
+# of drawing them again.
+#
+# A run can also start mid-epidemic from the case counts of each community
+# in a csv file, given as "scenario": {"cases": "cases.csv"}, see read_cases().
+import csv, hashlib, json, math, os, shutil, socket
+import numpy as np
+
+import config
+
+
+# Sizes of the person and place squares, see Person.size and Place.size
+PERSON_SIZE = 5
+PLACE_SIZE = 15
+
+# Arrays of an initial state, saved as {name}.npy in its cache directory
+ARRAYS = ("x", "y", "place_x", "place_y")
+
+# Columns of a cases file, in the order of the counts returned by read_cases()
+CASES = ("community", "susceptible", "infected", "immune")
+
+
+def geometry(layout: list, sim_size: tuple) -> list:
+    '''
+    Lays the communities of a layout out on a surface.
+
+    Arguments:
+        layout: config.sim.layout
+        sim_size: (width, height) of the surface, see world_size()
+
+    Returns:
+        list of (coords, (width, height)) of each community, read row by row
+    '''
+    cells = []
+    sim_width, sim_height = sim_size
+    y_buffer = sim_height/(len(layout)*10) # The pixels between each row of communities
+    height = round((sim_height - (y_buffer*(len(layout)+1))) / len(layout))
+
+    for y, cols in enumerate(layout):
+
+        x_buffer = sim_width/(len(cols)*10)
+
+        width = round((sim_width - (x_buffer*(len(cols)+1))) / len(cols))
+        for x in range(len(cols)):
+
+            coords = round((x*(width+x_buffer)+x_buffer)), round(y*(height+y_buffer)+y_buffer)
+            cells.append((coords, (width, height)))
+
+    return cells
+
+
+def world_size(layout: list, sim_size: tuple, min_size: int) -> tuple:
+    '''
+    Returns the size of the world communities are laid out on, the
+    simulation surface grown until every community is at least min_size
+    pixels across. The window shows it through a viewport.Camera.
+
+    Arguments:
+        layout: config.sim.layout
+        sim_size: config.app.sim_size
+        min_size: config.app.min_community
+    '''
+    rows = len(layout)
+    cols = max(len(row) for row in layout)
+
+    # Buffers take 1/10 of a community's share on each side, see geometry()
+    width = math.ceil(min_size*cols / (1 - (cols+1)/(cols*10))) + 1
+    height = math.ceil(min_size*rows / (1 - (rows+1)/(rows*10))) + 1
+
+    return max(sim_size[0], width), max(sim_size[1], height)
+
+
+# Digests of the files read in this process, by path, modification time and size
+_digests = {}
+
+
+def file_digest(path: str) -> str:
+    '''
+    Returns the sha1 of the contents of a file, read a block at a time. A
+    file is only read again once its modification time or size changes.
+    '''
+    status = os.stat(path)
+    key = (os.path.abspath(path), status.st_mtime_ns, status.st_size)
+
+    if key not in _digests:
+        digest = hashlib.sha1()
+        with open(path, "rb") as source:
+            for block in iter(lambda: source.read(1 << 20), b""):
+                digest.update(block)
+        _digests[key] = digest.hexdigest()
+    return _digests[key]
+
+
+def read_cases(path: str, populations: list) -> np.ndarray:
+    '''
+    Reads the number of susceptible, infected and immune people of each
+    community from a csv file with a header naming the columns in CASES.
+    Communities are numbered from 0 in the order the layout is read, row by
+    row. Rows of the same community are added together and communities
+    without a row start with everybody susceptible. The file is read a row
+    at a time, so its size does not matter.
+
+    Arguments:
+        path: path of the csv file
+        populations: population of each community
+
+    Returns:
+        (communities, 3) array of the susceptible, infected and immune counts
+    '''
+    populations = np.asarray(populations, dtype=np.int64)
+    counts = np.zeros((populations.shape[0], 3), dtype=np.int64)
+    listed = np.zeros(populations.shape[0], dtype=bool)
+
+    with open(path, "r", newline="") as cases:
+        reader = csv.reader(cases)
+        header = [name.strip().lower() for name in next(reader, [])]
+
+        missing = [name for name in CASES if name not in header]
+        if len(missing) > 0:
+            raise ValueError(f'Missing columns in {path}: {", ".join(missing)}')
+        columns = [header.index(name) for name in CASES]
+
+        for line, row in enumerate(reader, 2):
+            if len(row) == 0:
+                continue
+            try:
+                community, *values = (int(row[column]) for column in columns)
+            except (IndexError, ValueError):
+                raise ValueError(f'Line {line} of {path} must have a whole number in every column')
+
+            if not 0 <= community < populations.shape[0]:
+                raise ValueError(f'Line {line} of {path}: there is no community {community}')
+            if min(values) < 0:
+                raise ValueError(f'Line {line} of {path}: counts cannot be negative')
+
+            counts[community] += values
+            listed[community] = True
+
+    counts[~listed, 0] = populations[~listed]
+
+    wrong = np.flatnonzero(counts.sum(axis=1) != populations)
+    if wrong.shape[0] > 0:
+        raise ValueError(f'Counts in {path} must add up to the population of community {wrong[0]}')
+
+    return counts
+
+
+class Scenario:
+    '''
+    Purpose: The layout of a configuration, validated and laid out once.
+
+    Args:
+        layout: config.sim.layout
+        sim_size: config.app.sim_size
+        cache: directory initial states are cached in, None to not cache
+        min_size: smallest width and height of a community, see world_size()
+        cases: csv file of the counts to start from, None to start from a
+            single infected person, see read_cases()
+    '''
+
+    def __init__(self, layout: list, sim_size: tuple, cache=None, min_size=0, cases=None) -> None:
+
+        self.layout = layout
+        self.sim_size = tuple(sim_size)
+        self.cache = cache
+
+        self.world_size = world_size(layout, sim_size, min_size)
+        self.cells = geometry(layout, self.world_size)
+        # The pixels between each row of communities
+        self.y_buffer = sim_size[1]/(len(layout)*10)
+
+        self.sizes = np.array([size for _, size in self.cells], dtype=np.float64)
+        self.populations = [pop for cols in layout for pop, _ in cols]
+        self.places = [count for cols in layout for _, count in cols]
+        self.communities = len(self.populations)
+        self.people = sum(self.populations)
+
+        # Susceptible, infected and immune people of each community at the start
+        self.cases = None if cases is None else read_cases(cases, self.populations)
+
+        # Only the layout and the world it is laid out on shape the initial
+        # positions, the contents of the cases file the initial states
+        shape = {"layout": layout, "world_size": list(self.world_size)}
+        if cases is not None:
+            shape["cases"] = file_digest(cases)
+        self.digest = hashlib.sha1(json.dumps(shape, sort_keys=True).encode()).hexdigest()
+
+    def initial(self, rng: np.random.Generator, seed=None, replicates=1) -> dict:
+        '''
+        Returns the initial positions of every person and place of a number
+        of copies of the layout, drawn from rng or read from the cache.
+
+        When the state is read from the cache, rng is left exactly where
+        drawing it would have left it, so a seeded run continues the same
+        either way.
+
+        Arguments:
+            rng: generator seeded with seed
+            seed: seed of rng, states are only cached for seeded generators
+            replicates: number of copies of the layout
+
+        Returns:
+            dict of the arrays in ARRAYS, person arrays hold every person of
+            replicate 0 first, place arrays every place of replicate 0 first
+        '''
+        if self.cache is None or seed is None:
+            return self.__draw(rng, replicates)
+
+        path = os.path.join(self.cache, f'{self.digest}-{seed}-{replicates}')
+        if self.__complete(path):
+            with open(os.path.join(path, "rng.json"), "r") as state:
+                rng.bit_generator.state = json.load(state)
+            return {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode="r") for name in ARRAYS}
+
+        arrays = self.__draw(rng, replicates)
+
+        # Written to a temporary directory and moved into place, so processes
+        # drawing the same state at once never read a partial one
+        temporary = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+        os.makedirs(temporary, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(temporary, f'{name}.npy'), arrays[name])
+        with open(os.path.join(temporary, "rng.json"), "w") as state:
+            json.dump(rng.bit_generator.state, state)
+
+        # A state left incomplete, by a process killed before the move was
+        # atomic, would make the move fail on every later run
+        if os.path.exists(path) and not self.__complete(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+        try:
+            os.replace(temporary, path)
+        # Another process moved the same state into place first
+        except OSError:
+            shutil.rmtree(temporary, ignore_errors=True)
+
+        return arrays
+
+    @staticmethod
+    def __complete(path: str) -> bool:
+        '''
+        Returns whether a cached state has every one of its files.
+        '''
+        names = [f'{name}.npy' for name in ARRAYS] + ["rng.json"]
+        return all(os.path.exists(os.path.join(path, name)) for name in names)
+
+    def __draw(self, rng: np.random.Generator, replicates: int) -> dict:
+        '''
+        Draws random positions for every person and place.
+        '''
+        group = np.tile(np.repeat(np.arange(self.communities), self.populations), replicates)
+        limit_x = self.sizes[:, 0] - PERSON_SIZE
+        limit_y = self.sizes[:, 1] - PERSON_SIZE
+
+        x = rng.integers(1, limit_x[group] + 1).astype(np.float64)
+        y = rng.integers(1, limit_y[group] + 1).astype(np.float64)
+
+        community = np.tile(np.repeat(np.arange(self.communities), self.places), replicates)
+        place_x = rng.integers(1, self.sizes[community, 0] - PLACE_SIZE + 1) + PLACE_SIZE/2
+        place_y = rng.integers(1, self.sizes[community, 1] - PLACE_SIZE + 1) + PLACE_SIZE/2
+
+        return {"x": x, "y": y, "place_x": place_x, "place_y": place_y}
+
+
+# Scenarios compiled in this process, by the configuration they came from
+_compiled = {}
+
+
+def current() -> Scenario:
+    '''
+    Returns the loaded configuration compiled, once per distinct layout.
+    '''
+    cache = config.scenario.get("cache")
+    cases = config.scenario.get("cases")
+    # A cases file edited since it was read is read again, file_digest()
+    # only reads it again once it changed
+    contents = None if cases is None else file_digest(cases)
+    key = (json.dumps(config.sim.layout), tuple(config.app.sim_size), cache, config.app.min_community, cases, contents)
+
+    if key not in _compiled:
+        _compiled[key] = Scenario(config.sim.layout, config.app.sim_size, cache, config.app.min_community, cases)
+    return _compiled[key]
@@ -0,0 +1,299 @@
+# Work queue of headless runs shared by any number of workers.
+#
+# A sweep is a set of jobs, each a configuration in the form config.json
+# takes plus a seed, kept in a SQLite database. Workers on any host that can
+# reach the database and the results directory claim jobs one at a time, run
+# them with engine.Engine and commit the results. Results are stored by the
+# hash of the configuration, seed and version of the simulation code, so a
+# job already computed by any sweep is not run again, and an interrupted
+# sweep resumes where it stopped. Jobs claimed by a worker that died are
+# handed out again once their lease runs out.
+#
+# Usage:
+#   python sweep.py add sweep.db config.json [config.json ...] first_seed last_seed [cycles] [replicates]
+#   python sweep.py work sweep.db [lease seconds]
+#   python sweep.py status sweep.db
+#   python sweep.py collect sweep.db output.csv
+#
+# SQLite locking relies on the filesystem, network filesystems without
+# working locks should give every host its own database.
+import hashlib, json, os, socket, sqlite3, sys, time, traceback
+import numpy as np
+
+import config, analytics, scenario
+
+
+# Modules whose code decides the results of a run
+SOURCES = ("config.py", "engine.py", "kernels.py", "migration.py", "scenario.py", "analytics.py",
+        "interventions.py")
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    key TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    config TEXT NOT NULL,
+    seed INTEGER NOT NULL,
+    cycles INTEGER NOT NULL,
+    replicates INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    claimed REAL,
+    error TEXT
+)
+'''
+
+
+def version() -> str:
+    '''
+    Returns a hash of the simulation code, results of other versions are not reused.
+    '''
+    digest = hashlib.sha1()
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    for name in SOURCES:
+        with open(os.path.join(here, name), "rb") as source:
+            digest.update(source.read())
+
+    return digest.hexdigest()
+
+
+def job_key(settings: dict, seed: int, cycles: int, replicates: int, code: str) -> str:
+    '''
+    Returns the content address of the results of a job. Files the
+    configuration names are addressed by their contents, so editing them
+    does not return results of the old ones.
+    '''
+    job = {"config": settings, "seed": seed, "cycles": cycles, "replicates": replicates, "version": code}
+
+    cases = settings.get("scenario", {}).get("cases")
+    if cases is not None:
+        job["cases"] = scenario.file_digest(cases)
+    return hashlib.sha1(json.dumps(job, sort_keys=True).encode()).hexdigest()
+
+
+class Results:
+    '''
+    Purpose: Content addressed store of the results of jobs.
+
+    Args:
+        path: directory the results are kept in
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def file(self, key: str) -> str:
+        '''
+        Returns where the results of a job are stored.
+        '''
+        return os.path.join(self.path, key[:2], f'{key}.npz')
+
+    def has(self, key: str) -> bool:
+        '''
+        Returns whether the results of a job are stored.
+        '''
+        return os.path.exists(self.file(key))
+
+    def save(self, key: str, history: np.ndarray, metrics: dict) -> None:
+        '''
+        Stores the results of a job. They are written to a temporary file and
+        moved into place, so readers never see a partial result.
+        '''
+        path = self.file(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        temporary = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+        with open(temporary, "wb") as result:
+            np.savez(result, history=history, **metrics)
+        os.replace(temporary, path)
+
+    def load(self, key: str) -> dict:
+        '''
+        Returns the history and metrics of a job.
+        '''
+        with np.load(self.file(key)) as result:
+            return {name: result[name] for name in result.files}
+
+
+class Queue:
+    '''
+    Purpose: The jobs of a sweep in a SQLite database.
+
+    Args:
+        path: path of the database, created if missing
+        results: directory of the result store, defaults to results/ next to the database
+    '''
+
+    def __init__(self, path: str, results=None) -> None:
+
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute(SCHEMA)
+        self.results = Results(results or os.path.join(os.path.dirname(os.path.abspath(path)), "results"))
+        self.code = version()
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+
+    def add(self, name: str, settings: dict, seeds: range, cycles: int, replicates: int) -> int:
+        '''
+        Adds a job for every seed of a configuration. Jobs already in the
+        queue are left as they are, and jobs with stored results are added
+        as done.
+
+        Returns:
+            number of jobs added
+        '''
+        added = 0
+        for seed in seeds:
+            key = job_key(settings, seed, cycles, replicates, self.code)
+            status = "done" if self.results.has(key) else "pending"
+
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO jobs (key, name, config, seed, cycles, replicates, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, name, json.dumps(settings), seed, cycles, replicates, status))
+            added += cursor.rowcount
+
+        return added
+
+    def claim(self, lease: float):
+        '''
+        Claims the next pending job, or a running one whose lease ran out.
+
+        Returns:
+            (id, key, config, seed, cycles, replicates) or None when no job is left
+        '''
+        now = time.time()
+
+        # An immediate transaction takes the write lock, so no two workers claim the same job
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            job = self.db.execute(
+                "SELECT id, key, config, seed, cycles, replicates FROM jobs "
+                "WHERE status = 'pending' OR (status = 'running' AND claimed < ?) ORDER BY id LIMIT 1",
+                (now - lease,)).fetchone()
+
+            if job is not None:
+                self.db.execute("UPDATE jobs SET status = 'running', worker = ?, claimed = ? WHERE id = ?",
+                        (self.worker, now, job[0]))
+        finally:
+            self.db.execute("COMMIT")
+
+        return job
+
+    def finish(self, id: int, error=None) -> None:
+        '''
+        Marks a claimed job as done, or failed with the error given.
+        '''
+        status = "done" if error is None else "failed"
+        self.db.execute("UPDATE jobs SET status = ?, error = ? WHERE id = ?", (status, error, id))
+
+    def work(self, lease=3600) -> int:
+        '''
+        Runs jobs until none are left.
+
+        Arguments:
+            lease: seconds after which a job claimed by another worker that
+                has not finished is assumed lost and run again
+
+        Returns:
+            number of jobs run
+        '''
+        import engine
+
+        run = 0
+        while True:
+
+            job = self.claim(lease)
+            if job is None:
+                return run
+            id, key, settings, seed, cycles, replicates = job
+
+            # Another sweep may have computed the same job already
+            if self.results.has(key):
+                self.finish(id)
+                continue
+
+            try:
+                # Results are stored under the key of the inputs they were computed from
+                if job_key(json.loads(settings), seed, cycles, replicates, self.code) != key:
+                    raise ValueError("The code or a file of the configuration changed since the job was added")
+
+                config.apply(json.loads(settings))
+                simulation = engine.Engine(seed, replicates)
+                history = simulation.run(cycles)
+                self.results.save(key, history, simulation.analytics.snapshot())
+            except Exception:
+                self.finish(id, traceback.format_exc())
+                continue
+
+            self.finish(id)
+            run += 1
+
+    def status(self) -> dict:
+        '''
+        Returns the number of jobs in each status.
+        '''
+        return dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def collect(self, path: str) -> None:
+        '''
+        Writes the final counts and metrics of every replicate of every done
+        job to a csv file.
+        '''
+        header = ["name", "seed", "replicate", "susceptible", "infected", "immune", "dead"] + list(analytics.METRICS)
+        rows = [",".join(header)]
+
+        jobs = self.db.execute("SELECT key, name, seed FROM jobs WHERE status = 'done' ORDER BY id").fetchall()
+        for key, name, seed in jobs:
+            result = self.results.load(key)
+            final = result["history"][-1]
+
+            for replicate in range(final.shape[0]):
+                values = list(final[replicate]) + [result[metric][replicate] for metric in analytics.METRICS]
+                rows.append(",".join([name, str(seed), str(replicate)] + [f'{value:g}' for value in values]))
+
+        with open(path, "w") as output:
+            output.write("\n".join(rows) + "\n")
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 3:
+        sys.exit("Usage: python sweep.py add|work|status|collect sweep.db ...")
+
+    command, path = sys.argv[1], sys.argv[2]
+    queue = Queue(path)
+
+    if command == "add":
+        # Config files come first, then the seed range and optional cycles and replicates
+        files = [arg for arg in sys.argv[3:] if arg.endswith(".json")]
+        numbers = [int(arg) for arg in sys.argv[3:] if not arg.endswith(".json")]
+        if len(files) == 0 or len(numbers) < 2:
+            sys.exit("Usage: python sweep.py add sweep.db config.json [...] first_seed last_seed [cycles] [replicates]")
+
+        first, last = numbers[0], numbers[1]
+        cycles = numbers[2] if len(numbers) > 2 else 1000
+        replicates = numbers[3] if len(numbers) > 3 else 1
+
+        for name in files:
+            with open(name, "r") as config_file:
+                settings = json.loads(config_file.read())
+            # Validate before queueing so a bad file fails here rather than in every worker
+            config.apply(settings)
+            added = queue.add(name, settings, range(first, last + 1), cycles, replicates)
+            print(f'{added} jobs added from {name}')
+
+    elif command == "work":
+        lease = float(sys.argv[3]) if len(sys.argv) > 3 else 3600
+        print(f'{queue.work(lease)} jobs run')
+
+    elif command == "status":
+        for status, count in sorted(queue.status().items()):
+            print(f'{status}: {count}')
+
+    elif command == "collect":
+        output = sys.argv[3] if len(sys.argv) > 3 else "sweep.csv"
+        queue.collect(output)
+        print(f'Results written to {output}')
+
+    else:
+        sys.exit(f'Unknown command: {command}')
@@ -0,0 +1,242 @@
+# Contact tracing log and the epidemic statistics derived from it.
+#
+# Configured under "tracing" in config.json:
+#   enabled  - write every infection event to disk
+#   contacts - also write every contact found by the proximity pass
+#   path     - directory the logs are written to
+#   chunk    - number of events buffered in memory before a flush
+#   window   - cycles R and the generation interval are averaged over
+import os
+import numpy as np
+
+
+# Columns of each log and their on disk types
+SCHEMA = {
+    "infections": {
+        "infector": np.int32, # -1 for people infected from outside the simulation
+        "infectee": np.int32,
+        "tick": np.int32,
+        "community": np.int16,
+        "place": np.int16, # -1 for infections outside places
+    },
+    "contacts": {
+        "infected": np.int32,
+        "susceptible": np.int32,
+        "tick": np.int32,
+        "community": np.int16,
+    },
+}
+
+
+class ColumnStore:
+    '''
+    Purpose: Append-only columnar buffer that is flushed to disk in chunks.
+    Each column is preallocated and written into in place, so appending a
+    row allocates nothing.
+
+    Args:
+        path: directory the columns are written to
+        name: key of SCHEMA describing the columns
+        chunk: number of rows held in memory before being flushed
+    '''
+
+    def __init__(self, path: str, name: str, chunk: int) -> None:
+
+        self.chunk = chunk
+        self.size = 0
+        self.rows = 0
+
+        self.columns = []
+        self.files = []
+        for column, dtype in SCHEMA[name].items():
+            self.columns.append(np.empty(chunk, dtype=dtype))
+            self.files.append(open(os.path.join(path, f'{name}.{column}.bin'), "wb"))
+
+    def full(self) -> bool:
+        '''
+        Returns whether the buffer must be flushed before the next append.
+        '''
+        return self.size == self.chunk
+
+    def flush(self) -> None:
+        '''
+        Appends the buffered rows to the column files.
+        '''
+        for column, file in zip(self.columns, self.files):
+            column[:self.size].tofile(file)
+
+        self.rows += self.size
+        self.size = 0
+
+    def close(self) -> None:
+        self.flush()
+        for file in self.files:
+            file.close()
+
+
+def read(path: str, name: str) -> dict:
+    '''
+    Loads a log written by ColumnStore.
+
+    Arguments:
+        path: directory the log was written to
+        name: "infections" or "contacts"
+
+    Returns:
+        dict of column name to numpy array
+    '''
+    return {
+        column: np.fromfile(os.path.join(path, f'{name}.{column}.bin'), dtype=dtype)
+        for column, dtype in SCHEMA[name].items()
+    }
+
+
+class Tracer:
+    '''
+    Purpose: Records who infected whom and estimates the reproduction number
+    and generation interval from it.
+
+    R is the mean number of people infected by the cases that were cured or
+    died over the last window cycles, so it only counts cases whose
+    infectious period is complete. The generation interval is the mean number
+    of cycles between an infector being infected and them infecting someone.
+
+    Args:
+        settings: dict read from config.json
+    '''
+
+    def __init__(self, settings: dict) -> None:
+
+        self.enabled = settings.get("enabled", False)
+        self.window = settings.get("window", 300)
+        self.tick = 0
+
+        # Totals per cycle over the window, indexed by tick % window
+        self.resolved = [0] * self.window
+        self.offspring = [0] * self.window
+        self.generations = [0] * self.window
+        self.intervals = [0] * self.window
+
+        # Running sums of the above over the window
+        self.total_resolved = 0
+        self.total_offspring = 0
+        self.total_generations = 0
+        self.total_intervals = 0
+
+        self.infections = None
+        self.contacts = None
+
+        if self.enabled:
+            path = settings.get("path", "trace")
+            chunk = settings.get("chunk", 65536)
+            os.makedirs(path, exist_ok=True)
+
+            self.infections = ColumnStore(path, "infections", chunk)
+            if settings.get("contacts", False):
+                self.contacts = ColumnStore(path, "contacts", chunk)
+
+    def advance(self, tick: int) -> None:
+        '''
+        Moves the window on to a new cycle, forgetting the oldest one.
+        '''
+        self.tick = tick
+        slot = tick % self.window
+
+        self.total_resolved -= self.resolved[slot]
+        self.total_offspring -= self.offspring[slot]
+        self.total_generations -= self.generations[slot]
+        self.total_intervals -= self.intervals[slot]
+
+        self.resolved[slot] = 0
+        self.offspring[slot] = 0
+        self.generations[slot] = 0
+        self.intervals[slot] = 0
+
+    def infection(self, infector, infectee, community: int, place: int) -> None:
+        '''
+        Records an infection event.
+
+        Arguments:
+            infector: Person() or None when infected from outside
+            infectee: Person()
+            community: index of the community the infection happened in
+            place: index of the place the infection happened in, or -1
+        '''
+        infectee.infected_at = self.tick
+        infectee.infections = 0
+
+        if infector is not None:
+            infector.infections += 1
+
+            slot = self.tick % self.window
+            self.generations[slot] += 1
+            self.intervals[slot] += self.tick - infector.infected_at
+            self.total_generations += 1
+            self.total_intervals += self.tick - infector.infected_at
+
+        if self.infections is None:
+            return
+
+        log = self.infections
+        if log.full():
+            log.flush()
+
+        i = log.size
+        infector_id, infectee_id, tick, community_id, place_id = log.columns
+        infector_id[i] = infector.id if infector is not None else -1
+        infectee_id[i] = infectee.id
+        tick[i] = self.tick
+        community_id[i] = community
+        place_id[i] = place
+        log.size += 1
+
+    def contact(self, infected, susceptible, community: int) -> None:
+        '''
+        Records a contact found by the proximity pass.
+        '''
+        log = self.contacts
+        if log.full():
+            log.flush()
+
+        i = log.size
+        infected_id, susceptible_id, tick, community_id = log.columns
+        infected_id[i] = infected.id
+        susceptible_id[i] = susceptible.id
+        tick[i] = self.tick
+        community_id[i] = community
+        log.size += 1
+
+    def resolve(self, person) -> None:
+        '''
+        Records that an infected person was cured or died.
+        '''
+        slot = self.tick % self.window
+        self.resolved[slot] += 1
+        self.offspring[slot] += person.infections
+        self.total_resolved += 1
+        self.total_offspring += person.infections
+
+    def reproduction(self) -> float:
+        '''
+        Returns the mean number of infections caused by recently resolved cases.
+        '''
+        if self.total_resolved == 0:
+            return 0
+        return self.total_offspring / self.total_resolved
+
+    def generation_interval(self) -> float:
+        '''
+        Returns the mean number of cycles between successive infections in a chain.
+        '''
+        if self.total_generations == 0:
+            return 0
+        return self.total_intervals / self.total_generations
+
+    def close(self) -> None:
+        '''
+        Flushes and closes the logs.
+        '''
+        if self.infections is not None:
+            self.infections.close()
+        if self.contacts is not None:
+            self.contacts.close()
@@ -0,0 +1,119 @@
+# Camera over the world communities are laid out on.
+#
+# The world is the simulation surface grown until every community is big
+# enough to see, see scenario.world_size(). The window shows the part of it
+# the camera looks at, which can be panned by dragging with the mouse or
+# with W, A, S and D, and zoomed with the mouse wheel. HOME shows the whole
+# world again.
+import pygame
+
+
+# Pixels the camera pans per key press and the zoom change per wheel notch
+PAN = 40
+ZOOM = 1.25
+MAX_ZOOM = 8
+
+# Smallest size in pixels a person is drawn at, below it communities are heat tiles
+DETAIL = 2
+
+
+class Camera:
+    '''
+    Purpose: Maps rectangles of the world onto the simulation surface.
+
+    Args:
+        world_size: (width, height) of the world
+        view_size: (width, height) of the simulation surface
+    '''
+
+    def __init__(self, world_size: tuple, view_size: tuple) -> None:
+
+        self.world_size = world_size
+        self.view_size = view_size
+
+        # Zoom that fits the whole world in the view
+        self.fit = min(view_size[0] / world_size[0], view_size[1] / world_size[1])
+        self.reset()
+
+    def reset(self) -> None:
+        '''
+        Shows the whole world.
+        '''
+        self.zoom = self.fit
+        # World position shown at the top left of the view
+        self.x = 0
+        self.y = 0
+
+    def project(self, coords: tuple, size: tuple) -> pygame.Rect:
+        '''
+        Returns where a rectangle of the world lands on the view.
+
+        Arguments:
+            coords: (x, y) of the rectangle in the world
+            size: (width, height) of the rectangle
+        '''
+        left = round((coords[0] - self.x) * self.zoom)
+        top = round((coords[1] - self.y) * self.zoom)
+        right = round((coords[0] + size[0] - self.x) * self.zoom)
+        bottom = round((coords[1] + size[1] - self.y) * self.zoom)
+
+        return pygame.Rect(left, top, max(right - left, 1), max(bottom - top, 1))
+
+    def visible(self, rect: pygame.Rect) -> bool:
+        '''
+        Returns whether a projected rectangle shows on the view at all.
+        '''
+        return rect.right > 0 and rect.bottom > 0 and rect.left < self.view_size[0] and rect.top < self.view_size[1]
+
+    def pan(self, dx: float, dy: float) -> None:
+        '''
+        Moves the camera by a number of view pixels.
+        '''
+        self.x += dx / self.zoom
+        self.y += dy / self.zoom
+        self.__clamp()
+
+    def zoom_at(self, factor: float, pos: tuple) -> None:
+        '''
+        Zooms by a factor keeping the world position under pos still.
+
+        Arguments:
+            factor: above 1 zooms in, below 1 zooms out
+            pos: (x, y) on the view, usually the mouse
+        '''
+        zoom = min(max(self.zoom * factor, self.fit), MAX_ZOOM)
+
+        # World position under pos before and after the zoom must match
+        self.x += pos[0] / self.zoom - pos[0] / zoom
+        self.y += pos[1] / self.zoom - pos[1] / zoom
+        self.zoom = zoom
+        self.__clamp()
+
+    def handle(self, event: pygame.event.Event) -> None:
+        '''
+        Pans and zooms on mouse and key events.
+        '''
+        if event.type == pygame.MOUSEWHEEL:
+            self.zoom_at(ZOOM ** event.y, pygame.mouse.get_pos())
+
+        elif event.type == pygame.MOUSEMOTION and event.buttons[0]:
+            self.pan(-event.rel[0], -event.rel[1])
+
+        elif event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_a:
+                self.pan(-PAN, 0)
+            if event.key == pygame.K_d:
+                self.pan(PAN, 0)
+            if event.key == pygame.K_w:
+                self.pan(0, -PAN)
+            if event.key == pygame.K_s:
+                self.pan(0, PAN)
+            if event.key == pygame.K_HOME:
+                self.reset()
+
+    def __clamp(self) -> None:
+        '''
+        Keeps the view within the world.
+        '''
+        self.x = min(max(self.x, 0), max(self.world_size[0] - self.view_size[0] / self.zoom, 0))
+        self.y = min(max(self.y, 0), max(self.world_size[1] - self.view_size[1] / self.zoom, 0))